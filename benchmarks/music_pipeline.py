@@ -0,0 +1,484 @@
+"""Benchmarks cogs.music's pipeline end to end, without network access or FFmpeg.
+
+Usage: python benchmarks/music_pipeline.py [--plays 50] [--playlist-size 10000] [--guilds 50] [--mode download]
+                                           [--output results.json] [--compare previous.json]
+
+The real queue, prefetcher, extraction service, caches & stores are used, with local stand-ins for the outside world:
+- yt-dlp: cogs.utils.extraction._extract is replaced by FakeYoutubeDL, which sleeps for a configurable latency on the
+  extraction workers, then returns search results, playlist pages or videos (writing a small file when downloading).
+- Spotify: SpotifyStub, a local aiohttp server serving tokens, tracks & paginated playlists.
+- Discord voice: FakeVoiceClient reads 20ms frames on its own thread, like discord.py's AudioPlayer, from FakeFFmpegAudio,
+  which stands in for discord.FFmpegPCMAudio.
+
+Scenarios:
+- play: time from a play command to the first audio frame, for searches & URLs, one at a time.
+- playlist: enqueueing a Spotify & a YouTube playlist of --playlist-size tracks. Time until the command returns, and to load every page.
+- guilds: --guilds servers each playing --tracks-per-guild tracks at once. Time from one track ending to the next one's audio.
+Results are printed & saved as JSON (to benchmarks/results/ by default). --compare prints the change from a previous run."""
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import discord
+from aiohttp import web
+
+from cogs import music
+from cogs.utils import extraction, spotify
+from cogs.utils.cache import AudioCache
+from cogs.utils.events import EventBus
+from cogs.utils.extraction import ExtractionService
+from cogs.utils.guild_store import GuildStore
+from cogs.utils.metrics import MetricsRegistry
+from cogs.utils.resolutions import ResolutionCache
+from cogs.utils.slots import PlaybackSlots
+from cogs.utils.spotify import SpotifyClient
+
+FRAME = b'\0' * 3840  # 20ms of 48kHz stereo 16-bit PCM
+
+
+def _percentile(values, percent):
+    """Nearest-rank percentile."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(percent / 100 * len(ordered)) - 1))]
+
+def _summary(seconds):
+    """p50/p99/mean/max of a list of latencies, in milliseconds."""
+    if not seconds:
+        return {'count': 0}
+    return {
+        'count': len(seconds),
+        'p50_ms': round(_percentile(seconds, 50) * 1000, 2),
+        'p99_ms': round(_percentile(seconds, 99) * 1000, 2),
+        'mean_ms': round(sum(seconds) / len(seconds) * 1000, 2),
+        'max_ms': round(max(seconds) * 1000, 2),
+    }
+
+def _video_id(seed):
+    return hashlib.md5(seed.encode()).hexdigest()[:11]
+
+def _jittered(latency):
+    return latency * random.uniform(0.75, 1.25)
+
+
+class FakeYoutubeDL():
+    """Stands in for extraction._extract, which runs yt-dlp on the extraction service's workers."""
+    def __init__(self, directory, search_latency, extract_latency, download_latency, playlist_latency, playlist_size):
+        self.directory = directory
+        self.search_latency = search_latency
+        self.extract_latency = extract_latency
+        self.download_latency = download_latency
+        self.playlist_latency = playlist_latency
+        self.playlist_size = playlist_size
+        self.calls = 0
+
+    def __call__(self, profile, query, download, params=None):
+        self.calls += 1
+        if query.startswith('ytsearch'):
+            time.sleep(_jittered(self.search_latency))
+            terms = query.split(':', 1)[1]
+            return {'entries': [{'title': f"{terms} ({index})", 'url': f"https://www.youtube.com/watch?v={_video_id(f'{terms}{index}')}"}
+                                for index in range(5)]}
+        if 'list=' in query:
+            first, last = params['playlist_items'].split('-')
+            first, last = int(first), min(int(last or self.playlist_size), self.playlist_size)
+            # Like YouTube's, the fake playlist comes in pages of 100, and yt-dlp walks every page up to the last item asked for
+            time.sleep(_jittered(self.playlist_latency) * math.ceil(last / 100))
+            return {'playlist_count': self.playlist_size,
+                    'entries': [{'title': f"Playlist video {index}", 'url': f"https://www.youtube.com/watch?v={_video_id(f'playlist{index}')}"}
+                                for index in range(first, last + 1)]}
+
+        video_id = query.rsplit('v=', 1)[-1][:11]
+        info = {'id': video_id, 'extractor': 'youtube', 'title': f"Video {video_id}", 'duration': 180, 'format_id': '251', 'ext': 'webm',
+                'acodec': 'opus', 'protocol': 'https', 'webpage_url': query, 'url': f"https://media.invalid/{video_id}.webm"}
+        time.sleep(_jittered(self.extract_latency))
+        if download:
+            time.sleep(_jittered(self.download_latency))
+            info['filename'] = os.path.join(self.directory, AudioCache.outtmpl % info)
+            with open(info['filename'], 'wb') as file:
+                file.write(os.urandom(16 * 1024))
+        return info
+
+
+class SpotifyStub():
+    """Local stand-in for Spotify's token endpoint & Web API. Playlist 'bench<N>' has N tracks."""
+    def __init__(self, latency):
+        self.latency = latency
+        self.requests = 0
+        self.runner = None
+        self.url = None
+
+    async def start(self):
+        app = web.Application()
+        app.add_routes([
+            web.post('/api/token', self.token),
+            web.get('/v1/tracks/{track_id}', self.track),
+            web.get('/v1/playlists/{playlist_id}/tracks', self.playlist_tracks),
+        ])
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f'http://127.0.0.1:{port}'
+        # SpotifyClient reads these on every request
+        spotify.SPOTIFY_AUTH_URL = f'{self.url}/api/token'
+        spotify.SPOTIFY_API_URL = f'{self.url}/v1'
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    async def _delay(self):
+        self.requests += 1
+        await asyncio.sleep(_jittered(self.latency))
+
+    @staticmethod
+    def _track(index):
+        return {'name': f"Song {index}", 'artists': [{'name': f"Artist {index % 97}"}]}
+
+    async def token(self, request):
+        await self._delay()
+        return web.json_response({'access_token': 'bench', 'token_type': 'Bearer', 'expires_in': 3600})
+
+    async def track(self, request):
+        await self._delay()
+        return web.json_response(self._track(int(request.match_info['track_id'].lstrip('t') or 0)))
+
+    async def playlist_tracks(self, request):
+        await self._delay()
+        total = int(request.match_info['playlist_id'][len('bench'):])
+        offset = int(request.query.get('offset', 0))
+        limit = int(request.query.get('limit', 100))
+        items = [{'track': self._track(index)} for index in range(offset, min(offset + limit, total))]
+        return web.json_response({'items': items, 'total': total, 'offset': offset, 'limit': limit})
+
+
+class FakeFFmpegAudio(discord.AudioSource):
+    """Stands in for discord.FFmpegPCMAudio. Produces 'seconds' of silence, after 'startup' seconds for FFmpeg to start."""
+    startup = 0.05
+    seconds = 0.5
+
+    def __init__(self, source, *, before_options=None, options=None, **kwargs):
+        self.source = source
+        self._remaining = int(self.seconds * 50)
+        self._started = False
+
+    def read(self):
+        if not self._started:
+            self._started = True
+            time.sleep(self.startup)
+        if self._remaining <= 0:
+            return b''
+        self._remaining -= 1
+        return FRAME
+
+    def cleanup(self):
+        pass
+
+
+class FakeVoiceClient():
+    """Plays audio sources like discord.py's VoiceClient & AudioPlayer: frames are read every 20ms on a separate thread,
+    and 'after' is called from that thread when the source ends or is stopped."""
+    def __init__(self, loop, channel_id):
+        self.loop = loop
+        self.channel = SimpleNamespace(id=channel_id, name='Music')
+        self.first_audio_times = []  # time.perf_counter() of each source's first frame
+        self.end_times = []
+        self._thread = None
+        self._stopped = threading.Event()
+        self._paused = False
+
+    def play(self, source, *, after=None):
+        if self.is_playing():
+            raise discord.ClientException('Already playing audio.')
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(source, after, self._stopped), daemon=True)
+        self._thread.start()
+
+    def _run(self, source, after, stopped):
+        next_frame = None
+        while not stopped.is_set():
+            data = source.read()
+            if not data:
+                break
+            if next_frame is None:
+                self.first_audio_times.append(time.perf_counter())
+                next_frame = time.perf_counter()
+            next_frame += 0.02
+            stopped.wait(max(0.0, next_frame - time.perf_counter()))
+        self.end_times.append(time.perf_counter())
+        self._thread = None
+        if after:
+            after(None)
+
+    def is_playing(self):
+        return self._thread is not None
+
+    def is_paused(self):
+        return self._paused
+
+    def stop(self):
+        self._stopped.set()
+
+
+class FakeContext():
+    """The parts of a command's Context that the music pipeline uses."""
+    def __init__(self, loop, guild_id):
+        self.guild = SimpleNamespace(id=guild_id, name=f"Bench {guild_id}")
+        self.channel = SimpleNamespace(id=guild_id + 1)
+        self.author = SimpleNamespace(name='bench')
+        self.voice_client = FakeVoiceClient(loop, guild_id + 2)
+        self.invoked_at = None
+        self.sent = []
+
+    async def send(self, content=None, **kwargs):
+        self.sent.append(content)
+
+
+class BenchServer():
+    def __init__(self, bot, guild_id):
+        self.id = guild_id
+        self.settings = {'loop': False}
+        self.modules = {}
+        self.music = music._init_queue(bot, guild_id)
+
+
+class BenchServers(dict):
+    def __init__(self, bot):
+        super().__init__()
+        self.bot = bot
+
+    def __missing__(self, guild_id):
+        server = self[guild_id] = BenchServer(self.bot, guild_id)
+        return server
+
+
+class BenchBot():
+    """The services cogs.music expects on the bot, set up the way its setup() does, in a temporary directory."""
+    def __init__(self, loop, directory, args):
+        self.loop = loop
+        self.config = {'prefetch_depth': args.prefetch_depth, 'playback_mode': args.mode, 'opus_passthrough': False, 'resume_playback': False,
+                       'spotify_read_ahead': 2}
+        self.metrics = MetricsRegistry()
+        self.watchdog = None
+        self.player_events = EventBus()
+        self.playback_slots = PlaybackSlots(args.ffmpeg_limit)
+        os.makedirs(os.path.join(directory, 'downloads'))
+        self.extractor = ExtractionService(max_workers=args.ytdl_workers, metrics=self.metrics)
+        self.audio_cache = AudioCache(os.path.join(directory, 'downloads'))
+        self.resolutions = ResolutionCache(os.path.join(directory, 'resolutions.db'))
+        self.spotify = SpotifyClient('bench', 'bench')
+        self.queue_store = GuildStore(os.path.join(directory, 'queues.db'), 'queues')
+        self.queue_store.start()
+        self.server_data = BenchServers(self)
+
+    async def close(self):
+        for server in self.server_data.values():
+            server.music.prefetcher.cancel_all()
+        self.extractor.shutdown()
+        self.resolutions.close()
+        await self.queue_store.close()
+        await self.spotify.close()
+
+
+async def _wait_for_audio(voice_client, count, timeout=30):
+    deadline = time.perf_counter() + timeout
+    while len(voice_client.first_audio_times) < count:
+        if time.perf_counter() > deadline:
+            raise Exception("Timed out waiting for audio")
+        await asyncio.sleep(0.001)
+    return voice_client.first_audio_times[count - 1]
+
+async def _wait_until_stopped(bot, ctx, timeout=60):
+    queue = bot.server_data[ctx.guild.id].music
+    deadline = time.perf_counter() + timeout
+    while queue.current is not None or queue.tracks or ctx.voice_client.is_playing():
+        if time.perf_counter() > deadline:
+            raise Exception("Timed out waiting for the queue to finish")
+        await asyncio.sleep(0.005)
+
+async def _play(bot, ctx, query):
+    """Runs what the play command does, once the bot is in a voice channel."""
+    ctx.invoked_at = time.perf_counter()
+    ctx.audio_measured = False
+    await music._process_query(ctx, bot, query)
+    if not ctx.voice_client.is_playing() and not ctx.voice_client.is_paused():
+        await music._play_next_song(ctx, bot)
+
+async def bench_play(bot, args):
+    """Play command -> first audio frame, one server at a time, for new searches & new URLs."""
+    results = {}
+    for kind in ('search', 'url'):
+        latencies = []
+        for index in range(args.plays):
+            ctx = FakeContext(bot.loop, (len(bot.server_data) + 1) << 22)
+            query = f"bench artist {kind} {index}" if kind == 'search' else f"https://www.youtube.com/watch?v={_video_id(f'url{index}')}"
+            await _play(bot, ctx, query)
+            latencies.append(await _wait_for_audio(ctx.voice_client, 1) - ctx.invoked_at)
+            await _wait_until_stopped(bot, ctx)
+        results[kind] = _summary(latencies)
+    return results
+
+async def bench_playlist(bot, args):
+    """Enqueueing a large playlist: the command itself, then loading every page of it."""
+    results = {}
+    for kind in ('spotify', 'youtube'):
+        command_times, load_times, page_times = [], [], []
+        for repeat in range(args.playlist_repeats):
+            # A new YouTube playlist each time, as its pages would otherwise come from the extraction cache
+            url = f"https://open.spotify.com/playlist/bench{args.playlist_size}" if kind == 'spotify' else f"https://www.youtube.com/playlist?list=PLbench{repeat}"
+            ctx = FakeContext(bot.loop, (len(bot.server_data) + 1) << 22)
+            queue = bot.server_data[ctx.guild.id].music
+            queue.prefetcher.depth = 0  # Only measure loading the playlist, not downloading its tracks
+            start = time.perf_counter()
+            await music._process_query(ctx, bot, url)
+            command_times.append(time.perf_counter() - start)
+            cursor = next((track for track in queue.tracks if isinstance(track, music.PlaylistCursor)), None)
+            while cursor is not None:
+                page_start = time.perf_counter()
+                await music._load_playlist(bot, ctx.guild.id, cursor)
+                page_times.append(time.perf_counter() - page_start)
+                cursor = next((track for track in queue.tracks if isinstance(track, music.PlaylistCursor)), None)
+            load_times.append(time.perf_counter() - start)
+            if len(queue) != args.playlist_size:
+                raise Exception(f"Expected {args.playlist_size} tracks, got {len(queue)}")
+            queue.remove_from_queue()
+        results[kind] = {'command': _summary(command_times), 'full_load': _summary(load_times), 'page': _summary(page_times),
+                         'tracks_per_second': round(args.playlist_size / (sum(load_times) / len(load_times)))}
+    return results
+
+async def bench_guilds(bot, args):
+    """Many servers playing at once. Measures the gap between tracks, and overall throughput."""
+    contexts = [FakeContext(bot.loop, (len(bot.server_data) + 1 + index) << 22) for index in range(args.guilds)]
+
+    async def run_guild(ctx):
+        for index in range(1, args.tracks_per_guild):
+            bot.server_data[ctx.guild.id].music.enqueue(title=f"bench {ctx.guild.id} {index}", track_type="spotify", added_by='bench',
+                                                      url="https://open.spotify.com/playlist/bench")
+        await _play(bot, ctx, f"bench {ctx.guild.id} 0")
+        await _wait_until_stopped(bot, ctx, timeout=args.tracks_per_guild * 30)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[run_guild(ctx) for ctx in contexts])
+    elapsed = time.perf_counter() - start
+
+    first_audio, gaps = [], []
+    for ctx in contexts:
+        voice = ctx.voice_client
+        first_audio.append(voice.first_audio_times[0] - ctx.invoked_at)
+        gaps.extend(started - ended for ended, started in zip(voice.end_times, voice.first_audio_times[1:]))
+    tracks = sum(len(ctx.voice_client.first_audio_times) for ctx in contexts)
+    return {'first_audio': _summary(first_audio), 'track_gap': _summary(gaps), 'tracks': tracks,
+            'seconds': round(elapsed, 3), 'tracks_per_second': round(tracks / elapsed, 2)}
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def _flatten(results, prefix=''):
+    for key, value in results.items():
+        if isinstance(value, dict):
+            yield from _flatten(value, f"{prefix}{key}.")
+        else:
+            yield f"{prefix}{key}", value
+
+def _print_results(results, previous=None):
+    previous = dict(_flatten(previous)) if previous else {}
+    for key, value in _flatten(results):
+        line = f"{key:<40} {value}"
+        old = previous.get(key)
+        if isinstance(value, (int, float)) and isinstance(old, (int, float)) and old:
+            line += f"  (was {old}, {(value - old) / old * 100:+.1f}%)"
+        print(line)
+
+async def run(args):
+    random.seed(args.seed)
+    FakeFFmpegAudio.startup = args.ffmpeg_startup
+    FakeFFmpegAudio.seconds = args.track_seconds
+    discord.FFmpegPCMAudio = FakeFFmpegAudio
+    directory = tempfile.mkdtemp(prefix='kbot-bench-')
+    stub = SpotifyStub(args.spotify_latency)
+    await stub.start()
+    bot = BenchBot(asyncio.get_running_loop(), directory, args)
+    extraction._extract = FakeYoutubeDL(os.path.join(directory, 'downloads'), args.search_latency, args.extract_latency,
+                                        args.download_latency, args.playlist_latency, args.playlist_size)
+    results = {}
+    try:
+        for name, scenario in (('play', bench_play), ('playlist', bench_playlist), ('guilds', bench_guilds)):
+            if name in args.scenarios:
+                print(f"Running {name}...")
+                results[name] = await scenario(bot, args)
+    finally:
+        await bot.close()
+        await stub.stop()
+        shutil.rmtree(directory, ignore_errors=True)
+    results['extractor'] = {key: value for key, value in bot.extractor.stats().items() if key in ('completed', 'failed', 'avg_wait', 'max_wait')}
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenarios', nargs='+', default=['play', 'playlist', 'guilds'], choices=['play', 'playlist', 'guilds'])
+    parser.add_argument('--mode', default='download', choices=['download', 'stream'], help="PLAYBACK_MODE to benchmark.")
+    parser.add_argument('--plays', type=int, default=50)
+    parser.add_argument('--playlist-size', type=int, default=10000)
+    parser.add_argument('--playlist-repeats', type=int, default=3)
+    parser.add_argument('--guilds', type=int, default=50)
+    parser.add_argument('--tracks-per-guild', type=int, default=5)
+    parser.add_argument('--track-seconds', type=float, default=0.5, help="Length of every fake track.")
+    parser.add_argument('--ytdl-workers', type=int, default=4)
+    parser.add_argument('--prefetch-depth', type=int, default=2)
+    parser.add_argument('--ffmpeg-limit', type=int, help="FFMPEG_LIMIT, the most servers that play at once.")
+    parser.add_argument('--search-latency', type=float, default=0.3, help="Seconds per fake yt-dlp search. Every latency varies by +-25%%.")
+    parser.add_argument('--extract-latency', type=float, default=0.4, help="Seconds per fake yt-dlp video extraction.")
+    parser.add_argument('--download-latency', type=float, default=0.5, help="Extra seconds per fake download.")
+    parser.add_argument('--playlist-latency', type=float, default=0.05, help="Seconds per page of 100 videos that the fake yt-dlp walks through.")
+    parser.add_argument('--spotify-latency', type=float, default=0.05, help="Seconds per Spotify stub request.")
+    parser.add_argument('--ffmpeg-startup', type=float, default=0.05, help="Seconds until fake FFmpeg produces audio.")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="JSON file to write. Defaults to benchmarks/results/music_pipeline-<time>.json")
+    parser.add_argument('--compare', help="JSON file of a previous run to compare against.")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    report = {
+        'benchmark': 'music_pipeline',
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'settings': vars(args),
+        'results': results,
+    }
+    previous = None
+    if args.compare:
+        with open(args.compare, 'r') as file:
+            previous = json.load(file)['results']
+    _print_results(results, previous)
+
+    output = args.output or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results',
+                                         f"music_pipeline-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f"Saved results to {output}")
+
+if __name__ == '__main__':
+    main()
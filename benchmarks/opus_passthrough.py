@@ -0,0 +1,62 @@
+"""Measures the CPU cost per second of audio of the PCM & Opus passthrough sources used by cogs.music.
+
+Usage: python benchmarks/opus_passthrough.py <audio file> [--seconds 60]
+The file should be an Opus track, eg. a YouTube webm from ./downloads/. Requires FFmpeg & libopus."""
+import argparse
+import os
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import discord
+from discord.opus import Encoder
+
+from cogs.music import YTDLSource
+
+FRAMES_PER_SECOND = 50  # discord.py reads 20ms frames
+
+
+def _cpu_time():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)  # FFmpeg, once it has been reaped
+    return own.ru_utime + own.ru_stime, children.ru_utime + children.ru_stime
+
+def run(source, seconds):
+    """Reads frames the way discord.py's AudioPlayer does, encoding them if the source isn't Opus.
+    Returns (audio seconds read, bot CPU seconds, FFmpeg CPU seconds, wall seconds)."""
+    encoder = None if source.is_opus() else Encoder()
+    own_start, children_start = _cpu_time()
+    wall_start = time.perf_counter()
+    frames = 0
+    while frames < seconds * FRAMES_PER_SECOND:
+        data = source.read()
+        if not data:
+            break
+        if encoder:
+            encoder.encode(data, encoder.SAMPLES_PER_FRAME)
+        frames += 1
+    source.cleanup()
+    own_end, children_end = _cpu_time()
+    return frames / FRAMES_PER_SECOND, own_end - own_start, children_end - children_start, time.perf_counter() - wall_start
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('file')
+    parser.add_argument('--seconds', type=int, default=60, help="Seconds of audio to read from each source.")
+    args = parser.parse_args()
+
+    if not discord.opus.is_loaded():
+        discord.opus._load_default()
+
+    data = {'title': os.path.basename(args.file), 'filename': args.file, 'acodec': 'opus'}
+    for name, passthrough in (('pcm', False), ('passthrough', True)):
+        source = YTDLSource.from_data(data, passthrough=passthrough)
+        audio, own, ffmpeg, wall = run(source, args.seconds)
+        print(f"{name:>12}: {audio:.0f}s of audio in {wall:.2f}s. "
+              f"CPU per audio second: bot {own / audio * 1000:.2f}ms, FFmpeg {ffmpeg / audio * 1000:.2f}ms, "
+              f"total {(own + ffmpeg) / audio * 1000:.2f}ms")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""Measures the per-message cost of resolving command prefixes, before & after cogs.utils.prefixes.PrefixCache.
+Only some of the guilds have saved settings, so PrefixCache.get_prefix() also takes its path for guilds it has no entry for.
+
+Usage: python benchmarks/prefix_resolution.py [--guilds 5000] [--messages 1000000]"""
+import argparse
+import os
+import random
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cogs.utils.prefixes import PrefixCache
+
+DEFAULT_PREFIX = '!'
+
+
+def old_get_prefix(bot, message):
+    """kbot.get_prefix before PrefixCache, reading each server's settings dict."""
+    if message.guild:
+        if message.guild.id in bot.server_data:
+            return bot.server_data[message.guild.id].settings.get('prefix')
+    return DEFAULT_PREFIX
+
+def _make_bot(guilds, saved_share):
+    bot = SimpleNamespace(server_data={}, prefix_cache=PrefixCache(DEFAULT_PREFIX))
+    bot.prefix_cache.set_user(1234)
+    for guild_id in range(guilds):
+        settings = {'prefix': random.choice(['!', '?', '$']), 'loop': False, 'playlists': {}}
+        bot.server_data[guild_id] = SimpleNamespace(id=guild_id, settings=settings)
+        if random.random() < saved_share:
+            bot.prefix_cache.set(guild_id, settings['prefix'], mention=guild_id % 2 == 0)
+    return bot
+
+def bench(get_prefix, bot, messages):
+    """Returns the nanoseconds taken per message."""
+    start = time.perf_counter()
+    for message in messages:
+        get_prefix(bot, message)
+    return (time.perf_counter() - start) / len(messages) * 1e9
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--guilds', type=int, default=5000)
+    parser.add_argument('--messages', type=int, default=1000000)
+    parser.add_argument('--saved-share', type=float, default=0.5, help="Share of guilds with saved settings, ie. an entry in PrefixCache.")
+    args = parser.parse_args()
+
+    bot = _make_bot(args.guilds, args.saved_share)
+    guilds = [SimpleNamespace(id=guild_id) for guild_id in range(args.guilds)]
+    # Roughly 1 in 20 messages is a DM
+    messages = [SimpleNamespace(guild=None if random.random() < 0.05 else random.choice(guilds)) for _ in range(args.messages)]
+
+    for name, get_prefix in (('before', old_get_prefix), ('after', bot.prefix_cache.get_prefix)):
+        print(f"{name:>6}: {bench(get_prefix, bot, messages):6.1f}ns per message")
+
+if __name__ == '__main__':
+    main()
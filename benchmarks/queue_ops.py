@@ -0,0 +1,90 @@
+"""Compares cogs.music.Queue against the old list-of-dicts queue for large queues,
+and Queue's bulk operations against doing the same one track at a time.
+
+Usage: python benchmarks/queue_ops.py [--sizes 1000 10000 100000]"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cogs.music import Queue, Track
+
+
+class ListQueue():
+    """The list-backed queue that cogs.music.Queue replaced."""
+    def __init__(self):
+        self.tracks = []
+
+    def enqueue(self, title, track_type, added_by, url=None):
+        self.tracks.append({'title': title, 'url': url, 'track_type': track_type, 'added_by': added_by})
+
+    def remove_from_queue(self, index):
+        self.tracks.pop(index)
+
+    def next_song(self):
+        return self.tracks.pop(0) if self.tracks else None
+
+    def promote(self, index):
+        promoted_track = self.tracks.pop(index)
+        self.tracks = [promoted_track] + self.tracks
+
+
+def _fill(queue, size):
+    for i in range(size):
+        queue.enqueue(title=f"Artist {i}, Title {i}", track_type="spotify", added_by="benchmark", url="https://open.spotify.com/playlist/x")
+
+def _time(operation):
+    start = time.perf_counter()
+    operation()
+    return time.perf_counter() - start
+
+def bench(queue_class, size):
+    """Returns the seconds taken for each operation type on a queue of 'size' tracks."""
+    operations = min(1000, size // 4)
+    results = {}
+    queue = queue_class()
+    results['enqueue'] = _time(lambda: _fill(queue, size))
+    results['promote_last'] = _time(lambda: [queue.promote(len(queue.tracks) - 1) for _ in range(operations)])
+    indexes = [random.randrange(1, size - operations) for _ in range(operations)]
+    results['remove_random'] = _time(lambda: [queue.remove_from_queue(index) for index in indexes])
+    results['drain'] = _time(lambda: [queue.next_song() for _ in range(len(queue.tracks))])
+    return results
+
+def bench_bulk(size):
+    """Returns the seconds taken to do the same changes one track at a time, and with the bulk operations."""
+    count = size // 10
+    start = size // 2
+    tracks = [Track(f"Artist {i}, Title {i}", "https://open.spotify.com/playlist/x", "spotify", "benchmark") for i in range(size)]
+    results = {}
+
+    queue = Queue()
+    results['enqueue'] = _time(lambda: [queue.enqueue(title=track.title, track_type=track.track_type, added_by=track.added_by, url=track.url) for track in tracks])
+    queue = Queue()
+    results['enqueue_many'] = _time(lambda: queue.enqueue_many(tracks))
+
+    results['remove x10%'] = _time(lambda: [queue.remove_from_queue(start) for _ in range(count)])
+    queue = Queue()
+    queue.enqueue_many(tracks)
+    results['remove_range'] = _time(lambda: queue.remove_range(start, start + count))
+
+    results['promote x10%'] = _time(lambda: [queue.promote(start + count - 1) for _ in range(count)])
+    results['move_range'] = _time(lambda: queue.move_range(start, start + count, 0))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        for name, queue_class in (('list', ListQueue), ('Queue', Queue)):
+            results = bench(queue_class, size)
+            print(f"{name:>6} n={size:<7} " + "  ".join(f"{op} {seconds * 1000:8.2f}ms" for op, seconds in results.items()))
+        results = bench_bulk(size)
+        print(f"{'bulk':>6} n={size:<7} " + "  ".join(f"{op} {seconds * 1000:8.2f}ms" for op, seconds in results.items()))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,225 @@
+"""Fake Discord gateway & REST API, for running KBot (or launcher.py) locally without connecting to Discord.
+
+Usage: python benchmarks/stub_gateway.py [--port 8765] [--guilds 20] [--shards 2]
+Then run KBot with:
+    DISCORD_TOKEN=stub DISCORD_API_URL=http://127.0.0.1:8765/api/v10 DISCORD_GATEWAY_URL=ws://127.0.0.1:8765/gateway
+
+It implements just enough of Discord's API for discord.py to log in, identify each shard & receive its guilds.
+Messages can be sent to the bot with 'POST /stub/messages' {"guild_id": ..., "content": "!ping"}, and the bot's
+replies are printed & listed by 'GET /stub/sent'. 'GET /stub/shards' lists the connected shards & their guilds."""
+import argparse
+import asyncio
+import itertools
+import json
+import time
+
+from aiohttp import web, WSMsgType
+
+BOT_ID = 1000
+OWNER_ID = 1001
+_snowflakes = itertools.count(1 << 32)
+
+
+def guild_shard(guild_id, shard_count):
+    """The shard that Discord sends a guild to."""
+    return (guild_id >> 22) % shard_count
+
+def _json_response(data, status=200):
+    # discord.py only decodes responses whose Content-Type is exactly 'application/json', without a charset
+    return web.Response(body=json.dumps(data).encode(), status=status, content_type='application/json')
+
+def _user(user_id, name, bot=False):
+    return {'id': str(user_id), 'username': name, 'global_name': name, 'discriminator': '0', 'avatar': None, 'bot': bot}
+
+def _guild(guild_id):
+    text_channel_id = guild_id + 1
+    return {
+        'id': str(guild_id),
+        'name': f"Stub Server {guild_id >> 22}",
+        'owner_id': str(OWNER_ID),
+        'icon': None,
+        'features': [],
+        'roles': [{'id': str(guild_id), 'name': '@everyone', 'permissions': '8', 'position': 0, 'color': 0,
+                   'hoist': False, 'managed': False, 'mentionable': False}],
+        'emojis': [],
+        'stickers': [],
+        'channels': [
+            {'id': str(text_channel_id), 'type': 0, 'name': 'general', 'position': 0, 'permission_overwrites': []},
+            {'id': str(guild_id + 2), 'type': 2, 'name': 'Music', 'position': 1, 'permission_overwrites': [], 'bitrate': 64000, 'user_limit': 0},
+        ],
+        'members': [
+            {'user': _user(BOT_ID, 'KBot', bot=True), 'roles': [], 'joined_at': '2024-01-01T00:00:00+00:00', 'deaf': False, 'mute': False, 'flags': 0},
+            {'user': _user(OWNER_ID, 'stub-user'), 'roles': [], 'joined_at': '2024-01-01T00:00:00+00:00', 'deaf': False, 'mute': False, 'flags': 0},
+        ],
+        'member_count': 2,
+        'voice_states': [],
+        'threads': [],
+        'stage_instances': [],
+        'guild_scheduled_events': [],
+        'large': False,
+        'unavailable': False,
+    }
+
+
+class StubGateway():
+    def __init__(self, host, port, guild_count, shard_count):
+        self.host = host
+        self.port = port
+        self.shard_count = shard_count
+        self.identified_shard_count = shard_count  # The shard count the bot actually identified with
+        # Guild IDs are spread over the shards, the way Discord assigns them
+        self.guilds = {guild_id: _guild(guild_id) for guild_id in ((index + 1) << 22 for index in range(guild_count))}
+        self.shards = {}  # shard ID -> websocket
+        self.sent = []  # Messages the bot sent
+
+    def app(self):
+        app = web.Application()
+        app.add_routes([
+            web.get('/api/v10/users/@me', self.get_user),
+            web.get('/api/v10/oauth2/applications/@me', self.get_application),
+            web.get('/api/v10/gateway', self.get_gateway),
+            web.get('/api/v10/gateway/bot', self.get_gateway),
+            web.post('/api/v10/channels/{channel_id}/messages', self.create_message),
+            web.route('*', '/api/v10/{path:.*}', self.fallback),
+            web.get('/gateway', self.gateway),
+            web.get('/stub/shards', self.list_shards),
+            web.get('/stub/sent', self.list_sent),
+            web.post('/stub/messages', self.inject_message),
+        ])
+        return app
+
+    # REST API
+
+    async def get_user(self, request):
+        return _json_response(_user(BOT_ID, 'KBot', bot=True))
+
+    async def get_application(self, request):
+        return _json_response({
+            'id': str(BOT_ID), 'name': 'KBot', 'description': '', 'icon': None, 'bot_public': True,
+            'bot_require_code_grant': False, 'owner': _user(OWNER_ID, 'stub-user'), 'team': None,
+            'verify_key': '', 'flags': 0,
+        })
+
+    async def get_gateway(self, request):
+        return _json_response({
+            'url': f'ws://{self.host}:{self.port}/gateway',
+            'shards': self.shard_count,
+            'session_start_limit': {'total': 1000, 'remaining': 1000, 'reset_after': 0, 'max_concurrency': 16},
+        })
+
+    async def create_message(self, request):
+        body = await request.json()
+        message = self._message(int(request.match_info['channel_id']), body.get('content', ''), _user(BOT_ID, 'KBot', bot=True))
+        message['embeds'] = body.get('embeds', [])
+        self.sent.append(message)
+        print(f"[{message['channel_id']}] KBot: {message['content'] or json.dumps(message['embeds'])}")
+        return _json_response(message)
+
+    async def fallback(self, request):
+        # Anything else (eg. presence, application commands) just succeeds
+        return _json_response([] if request.method == 'GET' else {})
+
+    # Gateway
+
+    async def gateway(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        sequence = itertools.count(1)
+        shard_id = None
+
+        async def dispatch(event, data):
+            await ws.send_json({'op': 0, 't': event, 's': next(sequence), 'd': data})
+
+        await ws.send_json({'op': 10, 'd': {'heartbeat_interval': 41250}})
+        async for message in ws:
+            if message.type != WSMsgType.TEXT:
+                continue
+            payload = json.loads(message.data)
+            op, data = payload['op'], payload.get('d')
+            if op == 1:  # Heartbeat
+                await ws.send_json({'op': 11})
+            elif op == 2:  # Identify
+                shard_id, shard_count = data.get('shard', [0, 1])
+                guilds = [guild for guild_id, guild in self.guilds.items() if guild_shard(guild_id, shard_count) == shard_id]
+                self.shards[shard_id] = ws
+                self.identified_shard_count = shard_count
+                print(f"Shard {shard_id}/{shard_count} identified, sending {len(guilds)} guilds")
+                await dispatch('READY', {
+                    'v': 10, 'user': _user(BOT_ID, 'KBot', bot=True), 'session_id': f'stub-{shard_id}',
+                    'resume_gateway_url': f'ws://{self.host}:{self.port}/gateway', 'shard': [shard_id, shard_count],
+                    'application': {'id': str(BOT_ID), 'flags': 0},
+                    'guilds': [{'id': guild['id'], 'unavailable': True} for guild in guilds],
+                })
+                for guild in guilds:
+                    await dispatch('GUILD_CREATE', guild)
+            elif op == 6:  # Resume. Stub sessions can't be resumed
+                await ws.send_json({'op': 9, 'd': False})
+            elif op == 8:  # Request guild members
+                await dispatch('GUILD_MEMBERS_CHUNK', {
+                    'guild_id': data['guild_id'], 'members': self.guilds[int(data['guild_id'])]['members'],
+                    'chunk_index': 0, 'chunk_count': 1, 'nonce': data.get('nonce'),
+                })
+            # Presence & voice state updates are ignored
+        if self.shards.get(shard_id) is ws:
+            del self.shards[shard_id]
+        return ws
+
+    # Test controls
+
+    async def list_shards(self, request):
+        return _json_response({
+            shard_id: [str(guild_id) for guild_id in self.guilds if guild_shard(guild_id, self.identified_shard_count) == shard_id]
+            for shard_id in self.shards
+        })
+
+    async def list_sent(self, request):
+        return _json_response(self.sent)
+
+    async def inject_message(self, request):
+        """Sends a MESSAGE_CREATE to the shard that owns the guild, as if stub-user typed it in #general."""
+        body = await request.json()
+        guild_id = int(body['guild_id'])
+        ws = self.shards.get(guild_shard(guild_id, self.identified_shard_count))
+        if ws is None:
+            return _json_response({'error': 'No shard connected for that guild'}, status=404)
+        message = self._message(guild_id + 1, body['content'], _user(OWNER_ID, 'stub-user'))
+        message['guild_id'] = str(guild_id)
+        message['member'] = {'roles': [], 'joined_at': '2024-01-01T00:00:00+00:00', 'deaf': False, 'mute': False, 'flags': 0}
+        await ws.send_json({'op': 0, 't': 'MESSAGE_CREATE', 's': None, 'd': message})
+        return _json_response(message)
+
+    def _message(self, channel_id, content, author):
+        return {
+            'id': str(next(_snowflakes)), 'channel_id': str(channel_id), 'author': author, 'content': content,
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S+00:00', time.gmtime()), 'edited_timestamp': None,
+            'tts': False, 'mention_everyone': False, 'mentions': [], 'mention_roles': [], 'attachments': [],
+            'embeds': [], 'pinned': False, 'type': 0,
+        }
+
+
+async def serve(host, port, guilds, shards):
+    """Runs a StubGateway until cancelled. Also used by the benchmarks."""
+    stub = StubGateway(host, port, guilds, shards)
+    runner = web.AppRunner(stub.app())
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    print(f"Stub gateway listening on http://{host}:{port} with {guilds} guilds over {shards} shards")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--guilds', type=int, default=20)
+    parser.add_argument('--shards', type=int, default=2, help="Shard count recommended by GET /gateway/bot.")
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.host, args.port, args.guilds, args.shards))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,40 @@
 from discord.ext import commands
 import discord
-from quart import Blueprint, Quart, request, jsonify
+from quart import Blueprint, Quart, Response, make_response, request, jsonify, websocket
 import asyncio
+import hashlib
+import json
+import os
+import time
+from datetime import timedelta
+
+from cogs.utils.broadcast import BroadcastScheduler
+from cogs.utils.cache import TTLCache
 
 # init api object
 api = Blueprint('api', __name__, url_prefix='/api')
 
+MAX_PAGE_SIZE = 1000
+MAX_BROADCAST_SIZE = 1000
+KEEPALIVE_INTERVAL = 15
+
+
+def _server_sent_event(event):
+    return f"event: {event['event']}\ndata: {json.dumps(event, separators=(',', ':'))}\n\n".encode()
+
 
 class API(commands.Cog):
     def __init__(self, bot):
         self.bot: commands.Bot = bot
+        # Serialized responses, keyed by route & parameters. See cached_json()
+        self.responses = TTLCache(max_size=4096, ttl=self.bot.config["api_cache_ttl"])
+        self.broadcasts = BroadcastScheduler(bot, max_concurrency=self.bot.config["broadcast_concurrency"], rate=self.bot.config["broadcast_rate"])
         self.define_routes()
         self.quart = Quart(__name__)
         self.quart.register_blueprint(api)
         self.quart.bot = bot
+        # Prometheus scrapes /metrics, outside of /api
+        self.quart.add_url_rule('/metrics', 'metrics', self.metrics)
         self.webserver_task = None
         self.bot.loop.create_task(self.start_quart())
 
@@ -24,49 +45,104 @@ class API(commands.Cog):
                 await self.webserver_task
             except asyncio.CancelledError:
                 pass
-        self.webserver_task = asyncio.create_task(self.quart.run_task(host='0.0.0.0', port=5000))
+        # Without a shutdown_trigger, Hypercorn takes over SIGINT & SIGTERM, which should stop the whole bot. The task is cancelled instead
+        self.webserver_task = asyncio.create_task(self.quart.run_task(host=self.bot.config["api_host"], port=self.bot.config["api_port"],
+                                                                      shutdown_trigger=asyncio.Event().wait))
+
+    async def cached_json(self, key, build):
+        """Returns build()'s (data, headers) as a JSON response. The serialized response is cached for API_CACHE_TTL seconds,
+        and has an ETag so clients polling with If-None-Match get an empty 304 when nothing changed."""
+        entry = self.responses.get(key)
+        if entry is None:
+            data, headers = build()
+            body = json.dumps(data, separators=(',', ':')).encode()
+            entry = (body, hashlib.sha1(body).hexdigest(), headers)
+            self.responses.put(key, entry)
+        body, etag, headers = entry
+
+        headers = {**headers, 'ETag': f'"{etag}"', 'Cache-Control': f'max-age={int(self.responses.ttl)}'}
+        if etag in request.if_none_match:
+            return Response(b'', status=304, headers=headers)
+        return Response(body, status=200, content_type='application/json', headers=headers)
+
+    async def metrics(self):
+        return Response(self.bot.metrics.render(), content_type='text/plain; version=0.0.4')
 
     def define_routes(self):
         @api.route('/guilds/channels/message', methods=['POST'])
         async def send_message():
             data = await request.get_json()
-            channel = self.bot.get_channel(data['channel_id'])
+            channel = self.bot.get_channel(int(data['channel_id']))
             if channel:
-                asyncio.run_coroutine_threadsafe(
-                    channel.send(data['message']),
-                    self.bot.loop
-                )
-                return jsonify({'status': 'success'}), 200
+                try:
+                    message = await channel.send(data['message'])
+                except discord.HTTPException as e:
+                    return jsonify({'error': str(e)}), 502
+                return jsonify({'status': 'success', 'message_id': message.id}), 200
             return jsonify({'error': 'Channel not found'}), 404
 
+        @api.route('/guilds/channels/messages', methods=['POST'])
+        async def send_messages():
+            """Queues many messages at once. Takes {"messages": [{"channel_id": ..., "message": ...}, ...]} and returns a job,
+            whose progress can be followed with GET /api/jobs/<job_id>. See cogs.utils.broadcast for how sends are paced."""
+            data = await request.get_json(silent=True) or {}
+            messages = data.get('messages')
+            if not isinstance(messages, list) or not messages:
+                return jsonify({'error': "'messages' must be a list of {channel_id, message}"}), 400
+            if len(messages) > MAX_BROADCAST_SIZE:
+                return jsonify({'error': f"At most {MAX_BROADCAST_SIZE} messages can be sent per request"}), 400
+            if not all(isinstance(message, dict) and str(message.get('channel_id', '')).isdigit() and message.get('message') for message in messages):
+                return jsonify({'error': "Every message needs a 'channel_id' & a 'message'"}), 400
+            job = self.broadcasts.submit(messages)
+            return jsonify(job.to_dict()), 202
+
+        @api.route('/jobs/<job_id>', methods=['GET'])
+        async def get_job(job_id):
+            job = self.broadcasts.get(job_id)
+            if job is None:
+                return jsonify({'error': 'Job not found'}), 404
+            return jsonify(job.to_dict()), 200
+
+        @api.route('/watchdog/stalls', methods=['GET'])
+        async def list_stalls():
+            """Recent stalls of the event loop, with the stack that blocked it. Needs LOOP_WATCHDOG_THRESHOLD to be set."""
+            if not self.bot.watchdog:
+                return jsonify({'error': 'The watchdog is disabled. Set LOOP_WATCHDOG_THRESHOLD to enable it'}), 404
+            return jsonify(list(self.bot.watchdog.reports))
+
         @api.route('/guilds', methods=['GET'])
         async def get_guilds():
-            guilds = self.bot.guilds
-            output = []
-            for g in guilds:
-                output.append({"name": g.name, "id": g.id})
-            return jsonify(output), 200
-        
+            """Lists the bot's guilds by ID, 'limit' at a time (up to 1000). Pass the 'X-Next-Cursor' header of a page as 'after' to get the next page."""
+            after = request.args.get('after', 0, type=int)
+            limit = max(1, min(request.args.get('limit', MAX_PAGE_SIZE, type=int), MAX_PAGE_SIZE))
+
+            def build():
+                # Served from the gateway cache, so no REST calls are made
+                guilds = sorted((g for g in self.bot.guilds if g.id > after), key=lambda g: g.id)
+                output = [{"name": g.name, "id": g.id} for g in guilds[:limit]]
+                headers = {'X-Next-Cursor': str(output[-1]['id'])} if len(guilds) > limit else {}
+                return output, headers
+            return await self.cached_json(('guilds', after, limit), build)
+
         @api.route('/guilds/channels', methods=['GET'])
         async def get_channels_by_guild():
-            data = await request.get_json()
-            output = []
-            try:
-                guild: discord.Guild = await self.bot.fetch_guild(data['guild_id'])
-                channels = await guild.fetch_channels()
-                for ch in channels:
-                    if isinstance(ch, discord.TextChannel):
-                        output.append({"name": ch.name, "id": ch.id})
-                return jsonify(output), 200
-
-            except Exception as e:
-                print(e)
-                return jsonify(output), 404            
+            """Lists a guild's text channels. 'guild_id' can be given in the query string or the JSON body."""
+            data = await request.get_json(silent=True) or {}
+            guild_id = int(request.args.get('guild_id') or data.get('guild_id') or 0)
+            guild = self.bot.get_guild(guild_id)
+            if guild is None:
+                return jsonify([]), 404
+
+            def build():
+                return [{"name": ch.name, "id": ch.id} for ch in guild.text_channels], {}
+            return await self.cached_json(('channels', guild_id), build)
         
         @api.route('/guilds/player', methods=['GET'])
         async def get_guild_player():
-            data = await request.get_json()
-            guild: discord.Guild = self.bot.fetch_guild(data['guild_id'])
+            data = await request.get_json(silent=True) or {}
+            guild_id = int(request.args.get('guild_id') or data.get('guild_id') or 0)
+            if self.bot.get_guild(guild_id) is None:
+                return {'error': 'Guild not found'}, 404
             output = {
                 "active": False,
                 "title": None,
@@ -74,18 +150,81 @@ class API(commands.Cog):
                 "current_time": None,
                 "url": None
                 }
-            np = self.bot.server_data[data['guild_id']].music.now_playing
-            if np:
+            state = self.player_state(guild_id)
+            if state['active']:
                 output['active'] = True
-                output['title'] = np['title']
-                output['length'] = str(np['length'])
-                output['url'] = np['url']
+                output['title'] = state['title']
+                output['length'] = str(timedelta(seconds=state['length']))
+                output['current_time'] = str(timedelta(seconds=int(state['position'])))
+                output['url'] = state['url']
             return output, 200
 
+        @api.route('/guilds/player/events', methods=['GET'])
+        async def stream_player_events():
+            """Streams player events as Server-Sent Events, for the guild given by 'guild_id', or for every guild.
+            The first event is a 'state' snapshot. See cogs.utils.events for how slow clients are handled."""
+            if not hasattr(self.bot, 'player_events'):
+                return {'error': 'The music module is not loaded'}, 503
+            guild_id = request.args.get('guild_id', type=int)
+            subscription = self.bot.player_events.subscribe(guild_id)
+
+            async def stream():
+                with subscription:
+                    yield _server_sent_event(self.player_snapshot(guild_id))
+                    while True:
+                        try:
+                            event = await asyncio.wait_for(subscription.get(), KEEPALIVE_INTERVAL)
+                        except asyncio.TimeoutError:
+                            # Keeps proxies from closing an idle connection
+                            yield b': keepalive\n\n'
+                            continue
+                        yield _server_sent_event(event)
+
+            response = await make_response(stream(), 200, {'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache'})
+            response.timeout = None
+            return response
+
+        @api.websocket('/guilds/player/ws')
+        async def player_events_socket():
+            """Sends the same events as /guilds/player/events over a WebSocket, one JSON object per message."""
+            if not hasattr(self.bot, 'player_events'):
+                return
+            guild_id = websocket.args.get('guild_id', type=int)
+            with self.bot.player_events.subscribe(guild_id) as subscription:
+                await websocket.send_json(self.player_snapshot(guild_id))
+                while True:
+                    await websocket.send_json(await subscription.get())
+
+    def player_state(self, guild_id):
+        """Returns a guild's player state. Guilds that haven't used the music module aren't loaded just to report that nothing is playing."""
+        server = self.bot.server_data.get(guild_id)
+        queue = server.modules.get('music') if server else None
+        if queue is None:
+            return {'active': False, 'title': None, 'url': None, 'length': None, 'position': None, 'queued': 0}
+        return queue.player_state()
+
+    def player_snapshot(self, guild_id=None):
+        """Returns a 'state' event with a guild's player state, or with the state of every guild that's playing."""
+        if guild_id is not None:
+            data = self.player_state(guild_id) if self.bot.get_guild(guild_id) else {}
+        else:
+            data = {str(server.id): server.modules['music'].player_state() for server in self.bot.server_data.values()
+                    if server.modules.get('music') and server.modules['music'].current}
+        return {'event': 'state', 'guild_id': guild_id, 'time': time.time(), 'data': data}
+
     def cog_unload(self):
         if self.webserver_task and not self.webserver_task.done():
             self.webserver_task.cancel()
+        self.broadcasts.cancel_all()
 
 async def setup(bot):
     print("Loading Web API extension...")
+    # Worker processes started by launcher.py each get their own port, behind the launcher's coordinator
+    bot.config["api_host"] = os.environ.get('API_HOST', '0.0.0.0')
+    bot.config["api_port"] = int(os.environ.get('API_PORT', 5000))
+    # Seconds that GET responses are cached for
+    bot.config["api_cache_ttl"] = float(os.environ.get('API_CACHE_TTL', 5))
+    # Pacing of bulk messages. Discord allows 50 requests per second across the whole bot
+    bot.config["broadcast_concurrency"] = int(os.environ.get('BROADCAST_CONCURRENCY', 8))
+    bot.config["broadcast_rate"] = float(os.environ.get('BROADCAST_RATE', 40))
     await bot.add_cog(API(bot))
\ No newline at end of file
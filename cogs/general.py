@@ -24,11 +24,21 @@ class General(commands.Cog):
         await ctx.send(embed=aboutEmbed)
 
     @commands.hybrid_command()
-    async def setprefix(self, ctx, prefix):
-        """Sets the current server's command prefix."""
+    async def setprefix(self, ctx, *, prefixes):
+        """Sets the current server's command prefix. Several prefixes can be given, separated by spaces."""
         if not ctx.message.guild:
             return await ctx.send("This command can only be used in a server.")
-        result = self.bot.server_data[ctx.guild.id].set_prefix(prefix)
+        if not prefixes.split():
+            return await ctx.send("Please give at least one prefix.")
+        result = self.bot.server_data[ctx.guild.id].set_prefix(*prefixes.split())
+        await ctx.send(result)
+
+    @commands.hybrid_command()
+    async def mentionprefix(self, ctx, enabled:bool):
+        """Sets whether commands can also be used by mentioning KBot."""
+        if not ctx.message.guild:
+            return await ctx.send("This command can only be used in a server.")
+        result = self.bot.server_data[ctx.guild.id].set_mention_prefix(enabled)
         await ctx.send(result)
 
 async def setup(bot):
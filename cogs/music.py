@@ -1,18 +1,25 @@
 import asyncio
-import glob
 import json
 import logging
 import math
 import os
 import random
 import re
-import requests
+import time
 from datetime import timedelta
 from typing import Dict
 
 import discord
 from discord.ext import commands
-from yt_dlp import YoutubeDL
+
+from cogs.utils.blocklist import BlockList
+from cogs.utils.cache import AudioCache
+from cogs.utils.events import EventBus
+from cogs.utils.extraction import PRIORITY_PREFETCH, ExtractionRequest, ExtractionService
+from cogs.utils.guild_store import GuildStore
+from cogs.utils.resolutions import ResolutionCache
+from cogs.utils.slots import PlaybackSlots
+from cogs.utils.spotify import SpotifyClient
 
 # Initialize logger
 handler = logging.basicConfig(level=logging.WARNING,
@@ -21,77 +28,329 @@ handler = logging.basicConfig(level=logging.WARNING,
                               handlers=[logging.StreamHandler(), logging.FileHandler('kbot.log')], # Streamhandler will output to console, FileHandler outputs to kbot.log
                               )
 
-# Declaring ytdl search parameters
-ytdl_opts = {'logger': handler,
-             'format': 'bestaudio/bestaudio/best',  # Prioritize 128kbps audio
-             'outtmpl': 'downloads/%(title)s.%(ext)s',  # Downloaded files will be saved in a 'downloads' folder
-             'noplaylist': True,
-             'match_filter': lambda info_dict: "Livestream detected" if info_dict.get('is_live') else None,
-}
-ytdl_search_opts = {'logger': handler,
-                    'quiet': True,
-                    'default_search': 'ytsearch',
-                    'extract_flat': True,
-                    'force_generic_extractor': True,
-                    'ignoreerrors': True,
-                    'skip_download': True,
-                    'match_filter': lambda info_dict: "Livestream detected" if info_dict.get('is_live') else None,
+# FFmpeg options for reading a remote media URL. Reconnects if YouTube drops the connection mid-track.
+ffmpeg_stream_opts = {'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5',
+                      'options': '-vn',
 }
 
-# Declare ytdl classes
-ytdl_search = YoutubeDL(ytdl_search_opts)
-ytdl = YoutubeDL(ytdl_opts)
-
-class YTDLSource(discord.PCMVolumeTransformer):
-    def __init__(self, source, *, data):
+class PlaybackPosition():
+    """Mixin for audio sources that counts the 20ms frames discord.py reads, to know how far into the track playback is.
+    'on_first_frame()' is called once audio starts. It runs on discord.py's audio thread, not the event loop."""
+    frames = 0
+    start_at = 0
+    on_first_frame = None
+
+    def read(self):
+        self.frames += 1
+        if self.frames == 1 and self.on_first_frame:
+            self.on_first_frame()
+        return super().read()
+
+    @property
+    def position(self):
+        """Seconds into the track."""
+        return self.start_at + self.frames * 0.02
+
+class YTDLSource(PlaybackPosition, discord.PCMVolumeTransformer):
+    def __init__(self, source, *, data, start_at:float=0):
         super().__init__(source)
         self.data = data
         self.title = data.get('title')
         self.url = data.get('url')
+        self.start_at = start_at
+
+    @staticmethod
+    async def extract(url, *, extractor, cache=None, guild_id=None, stream:bool=False, request:ExtractionRequest=None):
+        """Downloads the given URL and returns its info dict, without creating an audio source.
+        If 'stream' is True, nothing is downloaded and the info dict's 'url' is streamed by FFmpeg instead.
+        Downloads go through 'cache' if given; the returned file is then pinned until released.
+        'request' sets the priority of the extraction, see ExtractionService."""
+        use_cache = cache is not None and not stream
+        data = cache.lookup(url) if use_cache else None
+        if data is None:
+            if stream:
+                data = await extractor.extract(url, profile='stream', guild_id=guild_id, request=request)
+            else:
+                # If the track is discarded mid-download, the file still lands in the cache's directory, so index it anyway
+                on_abandoned = (lambda info: cache.add(dict(info['entries'][0] if 'entries' in info else info), pin=False)) if use_cache else None
+                data = await extractor.extract(url, profile='download', download=True, guild_id=guild_id, request=request,
+                                               params={'paths': {'home': cache.directory}} if use_cache else None, on_abandoned=on_abandoned)
 
-    @classmethod
-    async def from_url(cls, url, *, loop=None):
-        loop = loop or asyncio.get_running_loop()
-        data = await loop.run_in_executor(None, lambda: ytdl.extract_info(url, download=True))
-
-        if 'entries' in data:
-            data = data['entries'][0]
+            # The extractor may share this info dict with other callers, so annotate a copy of it
+            data = dict(data['entries'][0] if 'entries' in data else data)
+            if use_cache:
+                cache.add(data)
 
         data['original_url'] = url
-        filename = ytdl.prepare_filename(data)
-        return cls(discord.FFmpegPCMAudio(filename), data=data)
+        data['streamed'] = stream
+        return data
+
+    @staticmethod
+    def is_streamable(data):
+        """Returns True if FFmpeg can read the info dict's media URL directly."""
+        return bool(data.get('url')) and data.get('protocol', 'https') in ('http', 'https')
+
+    @classmethod
+    def from_data(cls, data, *, passthrough:bool=False, start_at:float=0):
+        """Creates an audio source from an info dict returned by extract(), starting 'start_at' seconds in.
+        If 'passthrough' is True and the track is already Opus, returns a YTDLOpusSource instead."""
+        source = data['url'] if data.get('streamed') else data['filename']
+        ffmpeg_opts = dict(ffmpeg_stream_opts) if data.get('streamed') else {}
+        if start_at:
+            ffmpeg_opts['before_options'] = f"-ss {start_at:.2f} " + ffmpeg_opts.get('before_options', '')
+        if passthrough and YTDLOpusSource.can_passthrough(data):
+            return YTDLOpusSource(source, data=data, start_at=start_at, **ffmpeg_opts)
+        return cls(discord.FFmpegPCMAudio(source, **ffmpeg_opts), data=data, start_at=start_at)
+
+class YTDLOpusSource(PlaybackPosition, discord.FFmpegOpusAudio):
+    """Copies a track's existing Opus packets straight to Discord.
+    Skips decoding to PCM, scaling volume and re-encoding, but the volume can't be changed."""
+    def __init__(self, source, *, data, start_at:float=0, **kwargs):
+        super().__init__(source, codec='opus', **kwargs)
+        self.data = data
+        self.title = data.get('title')
+        self.url = data.get('url')
+        self.start_at = start_at
+
+    @staticmethod
+    def can_passthrough(data):
+        """Returns True if the track's audio is already Opus (eg. YouTube's webm formats)."""
+        return data.get('acodec') == 'opus'
+
+class Track():
+    """A single queued track. Uses __slots__, as queues can hold thousands of these."""
+    __slots__ = ('title', 'url', 'track_type', 'added_by')
+
+    def __init__(self, title:str, url:str, track_type:str, added_by:str):
+        self.title = title
+        self.url = url
+        self.track_type = track_type
+        self.added_by = added_by
+
+    def to_state(self):
+        """Returns a compact, JSON-serializable form of the track. See track_from_state()."""
+        return [self.title, self.url, self.track_type, self.added_by]
+
+class PlaylistCursor(Track):
+    """A single queue entry standing in for the tracks of a playlist that haven't been loaded yet.
+    When playback reaches it, the next page of tracks is loaded in front of it (see _load_playlist())."""
+    __slots__ = ('offset', 'total', 'page_size', 'loading', 'error', 'entries', 'pages')
+
+    def __init__(self, title:str, url:str, track_type:str, added_by:str, page_size:int):
+        super().__init__(title, url, track_type, added_by)
+        self.offset = 0  # Position in the playlist of the next page to load
+        self.total = None  # Number of tracks in the playlist, None if unknown
+        self.page_size = page_size
+        self.loading = None  # Task loading the next page, if any
+        self.error = None  # Exception raised by the last page load, if any
+        self.entries = None  # Every entry from 'offset' on, for playlists that are extracted in one go. Not saved.
+        self.pages = {}  # offset -> task fetching an upcoming page ahead of time (see _read_ahead()). Not saved.
+
+    @property
+    def remaining(self):
+        """Number of tracks not loaded yet, or None if unknown."""
+        return None if self.total is None else max(self.total - self.offset, 0)
+
+    def to_state(self):
+        return super().to_state() + [self.offset, self.total, self.page_size]
+
+def track_from_state(state:list):
+    """Recreates a Track or PlaylistCursor from its to_state() form."""
+    if len(state) > 4:
+        cursor = PlaylistCursor(*state[:4], page_size=state[6])
+        cursor.offset, cursor.total = state[4], state[5]
+        return cursor
+    return Track(*state)
 
 # Queue class, holds queue data & methods
 class Queue():
     def __init__(self, loop:bool=False, playlists:dict={}):
-        self.tracks = []
+        self.tracks = BlockList()
         self.now_playing = ""
+        self.current = None  # Track that is playing
+        self.player = None  # Audio source of the track that is playing
+        self.text_channel_id = None
+        self.voice_channel_id = None
+        self.resume_at = None  # (track, seconds) to start a restored track part way through
+        self.starting = False  # True while the next track is being prepared, see _play_next_song()
+        self._listeners = []
+
+    def __len__(self):
+        return len(self.tracks)
+
+    def add_listener(self, callback):
+        """Registers 'callback(event, track)', called after every change to the queue.
+        'track' is the affected track, or None for changes to the whole queue."""
+        self._listeners.append(callback)
+
+    def _notify(self, event:str, track=None):
+        for callback in self._listeners:
+            callback(event, track)
 
     def enqueue(self, title:str, track_type:str, added_by:str, url:str=None):
-        self.tracks.append({
-            'title': title,
-            'url': url,
-            'track_type': track_type,
-            'added_by': added_by
-        })
+        track = Track(title, url, track_type, added_by)
+        self.tracks.append(track)
+        self._notify('add', track)
+
+    def enqueue_many(self, tracks:list):
+        """Adds several Tracks at once, notifying listeners once."""
+        if tracks:
+            self.tracks.extend(tracks)
+            self._notify('add')
+
+    def enqueue_cursor(self, cursor:PlaylistCursor):
+        self.tracks.append(cursor)
+        self._notify('add', cursor)
+
+    def expand(self, cursor:PlaylistCursor, tracks:list, exhausted:bool):
+        """Inserts a page of a playlist's tracks in front of its cursor. Removes the cursor if 'exhausted'.
+        Returns False if the cursor is no longer in the queue."""
+        index = next((i for i, track in enumerate(self.tracks) if track is cursor), None)
+        if index is None:
+            return False
+        del self.tracks[index]
+        self.tracks.insert_many(index, tracks if exhausted else tracks + [cursor])
+        self._notify('expand', cursor)
+        return True
+
+    def track_count(self):
+        """Returns the number of tracks in the queue, counting the unloaded tracks of playlists."""
+        return sum(track.remaining or 0 if isinstance(track, PlaylistCursor) else 1 for track in self.tracks)
+
+    def set_now_playing(self, track, player, now_playing:dict):
+        """Records the track that started playing, or that nothing is playing if 'track' is None."""
+        self.current = track
+        self.player = player
+        self.now_playing = now_playing
+        self._notify('play' if track else 'stop', track)
+
+    def player_state(self):
+        """Returns what's playing & how far into it playback is, for the web API & player events."""
+        state = {'active': False, 'title': None, 'url': None, 'length': None, 'position': None, 'queued': self.track_count()}
+        if self.current and self.player:
+            state.update(active=True,
+                         title=self.now_playing['title'],
+                         url=self.now_playing['url'],
+                         length=self.now_playing['length'].total_seconds(),
+                         position=round(self.player.position, 1))
+        return state
+
+    def is_idle(self):
+        """Returns True if nothing is queued, playing, or about to play. See ServerRegistry in kbot.py."""
+        return not self.tracks and self.current is None and not self.starting
+
+    def take_resume_position(self, track):
+        """Returns how many seconds into 'track' playback should start, if it was interrupted by a restart."""
+        if self.resume_at and self.resume_at[0] is track:
+            position = self.resume_at[1]
+            self.resume_at = None
+            return position
+        return 0
+
+    def to_state(self):
+        """Returns a JSON-serializable snapshot of the queue & now playing track, or None if there's nothing to save."""
+        if not self.tracks and not self.current:
+            return None
+        return {
+            'tracks': [track.to_state() for track in self.tracks],
+            'current': self.current.to_state() if self.current else None,
+            'position': round(self.player.position, 2) if self.player else 0,
+            'text_channel': self.text_channel_id,
+            'voice_channel': self.voice_channel_id,
+        }
+
+    def load_state(self, state:dict, resume_current:bool=True):
+        """Restores a snapshot from to_state(). If 'resume_current', the interrupted track is put back at the top of the queue."""
+        self.tracks = BlockList(track_from_state(track) for track in state['tracks'])
+        self.text_channel_id = state.get('text_channel')
+        self.voice_channel_id = state.get('voice_channel')
+        if resume_current and state.get('current'):
+            track = track_from_state(state['current'])
+            self.tracks.appendleft(track)
+            self.resume_at = (track, state.get('position', 0))
+
+    def peek(self, count:int):
+        """Returns the next 'count' tracks without removing them."""
+        return self.tracks[:count]
+
+    def page(self, page:int, page_size:int=10):
+        """Returns the tracks on a 1-indexed page of the queue."""
+        return self.tracks[(page - 1) * page_size:page * page_size]
     
     def remove_from_queue(self, index:int=None):
         """If index parameter is given, remove that item from the queue.
         If no index is given, clears the entire queue."""
-        if index:
+        if index is not None:
             if 0 <= index < len(self.tracks):
                 removed = self.tracks.pop(index)
-                return f"Removed **{removed['title']}** from the queue."
+                self._notify('remove', removed)
+                return f"Removed **{removed.title}** from the queue."
             else:
                 raise Exception("Index is outside of queue range.")
         else:
-            self.tracks = []
+            self.tracks = BlockList()
+            self._notify('clear')
             return "Cleared the queue."
         
+    def remove_range(self, start:int, stop:int):
+        """Removes the tracks from index 'start' up to (not including) 'stop'. Costs about the same as removing one track."""
+        if not 0 <= start < stop <= len(self.tracks):
+            raise Exception("Index is outside of queue range.")
+        removed = self.tracks[start:stop]
+        del self.tracks[start:stop]
+        self._notify('remove', removed[0] if len(removed) == 1 else None)
+        if len(removed) == 1:
+            return f"Removed **{removed[0].title}** from the queue."
+        return f"Removed {len(removed)} tracks from the queue."
+
+    def remove_many(self, indexes):
+        """Removes the tracks at any set of indexes, in a single pass over the queue."""
+        indexes = set(indexes)
+        if not indexes:
+            return "Nothing to remove."
+        if min(indexes) < 0 or max(indexes) >= len(self.tracks):
+            raise Exception("Index is outside of queue range.")
+        self.tracks = BlockList(track for index, track in enumerate(self.tracks) if index not in indexes)
+        self._notify('remove')
+        return f"Removed {len(indexes)} tracks from the queue."
+
+    def move_range(self, start:int, stop:int, destination:int):
+        """Moves the tracks from index 'start' up to (not including) 'stop', so that the first of them ends up at index 'destination'."""
+        count = stop - start
+        if not 0 <= start < stop <= len(self.tracks):
+            raise Exception("Index is outside of queue range.")
+        if not 0 <= destination <= len(self.tracks) - count:
+            raise Exception(f"Position must be between 1 and {len(self.tracks) - count + 1}.")
+        moved = self.tracks[start:stop]
+        del self.tracks[start:stop]
+        self.tracks.insert_many(destination, moved)
+        self._notify('move', moved[0] if count == 1 else None)
+        return f"Moved {f'**{moved[0].title}**' if count == 1 else f'{count} tracks'} to position {destination + 1}."
+
+    def dedupe(self):
+        """Removes every track that's already earlier in the queue, keeping the first.
+        Spotify tracks are compared by title, as they share the URL of their playlist. Unloaded playlists are kept."""
+        seen = set()
+        tracks = BlockList()
+        for track in self.tracks:
+            if not isinstance(track, PlaylistCursor):
+                key = track.title if track.track_type == 'spotify' else track.url
+                if key in seen:
+                    continue
+                seen.add(key)
+            tracks.append(track)
+        removed = len(self.tracks) - len(tracks)
+        if removed:
+            self.tracks = tracks
+            self._notify('remove')
+        return f"Removed {removed} duplicate tracks from the queue."
+
     def next_song(self):
         """Removes & returns the next song in the queue."""
         if self.tracks:
-            return self.tracks.pop(0)
+            track = self.tracks.popleft()
+            self._notify('next', track)
+            return track
         return None
 
     def promote(self, index):
@@ -100,16 +359,21 @@ class Queue():
 
         if 0 < index < len(self.tracks):
             promoted_track = self.tracks.pop(index)
-            self.tracks = [promoted_track] + self.tracks
-            return f"Promoted {promoted_track['title']} to the top of the queue."
+            self.tracks.appendleft(promoted_track)
+            self._notify('promote', promoted_track)
+            return f"Promoted {promoted_track.title} to the top of the queue."
         elif 0 == index:
-            raise Exception(f"{self.tracks[index]['title']} is already at top of queue.")
+            raise Exception(f"{self.tracks[index].title} is already at top of queue.")
         else:
             raise Exception("Index is outside of queue range.")
 
     def shuffle_queue(self):
         if self.tracks:
-            random.shuffle(self.tracks)
+            # Shuffling in place would index the BlockList n times, so shuffle a plain list instead
+            tracks = list(self.tracks)
+            random.shuffle(tracks)
+            self.tracks = BlockList(tracks)
+            self._notify('shuffle')
             return "Queue has been shuffled."
         else:
             raise Exception("Queue is empty.")
@@ -133,9 +397,137 @@ class Queue():
     # def get_jukebox(self):
     #     return self.settings['playlists']
 
+class Prefetcher():
+    """Resolves & downloads the next few tracks of a guild's queue in the background, so the next song is ready when the current one ends.
+    Listens to the queue and cancels work for tracks that are removed, cleared, or pushed out of range.
+    Prefetches have a lower priority than the tracks servers are waiting to play, until they're claimed."""
+    def __init__(self, bot, guild_id, queue:Queue, depth:int=2):
+        self.bot = bot
+        self.guild_id = guild_id
+        self.queue = queue
+        self.depth = depth
+        self._tasks = {}  # id(track) -> (track, task, ExtractionRequest)
+        self._handoff = None  # (track, task, ExtractionRequest) of the track that was just dequeued
+        queue.add_listener(self._on_queue_change)
+
+    def _on_queue_change(self, event, track):
+        if event == 'next' and id(track) in self._tasks:
+            self._handoff = self._tasks.pop(id(track))
+        self.refresh()
+
+    def refresh(self):
+        """Starts work for the first 'depth' tracks, and cancels work for any other track."""
+        wanted = {}
+        for track in self.queue.peek(self.depth):
+            if isinstance(track, PlaylistCursor):
+                # Load the playlist's next page before playback reaches it. Tracks behind it can wait.
+                _load_playlist(self.bot, self.guild_id, track)
+                break
+            wanted[id(track)] = track
+        for key in list(self._tasks):
+            if key not in wanted:
+                self._discard(*self._tasks.pop(key))
+        for key, track in wanted.items():
+            if key not in self._tasks:
+                request = ExtractionRequest(PRIORITY_PREFETCH)
+                task = self.bot.loop.create_task(_resolve_track(self.bot, track, self.guild_id, request))
+                self._tasks[key] = (track, task, request)
+
+    def claim(self, track):
+        """Returns (task, ExtractionRequest) of the prefetch of a track that was just dequeued, or None if it was never prefetched."""
+        if self._handoff and self._handoff[0] is track:
+            track, task, request = self._handoff
+            self._handoff = None
+            return task, request
+        return None
+
+    def cancel_all(self):
+        for entry in self._tasks.values():
+            self._discard(*entry)
+        self._tasks = {}
+        if self._handoff:
+            self._discard(*self._handoff)
+            self._handoff = None
+
+    def _discard(self, track, task, request):
+        if not task.done():
+            task.cancel()
+        elif not task.cancelled() and not task.exception():
+            # Already downloaded, but no longer going to be played
+            url, data = task.result()
+            self.bot.audio_cache.release(data)
+
 class Music(commands.Cog):
-    def __init__(self, bot):
+    def __init__(self, bot, saved_queues:dict=None):
         self.bot = bot
+        self.saved_queues = saved_queues
+        self.position_task = self.bot.loop.create_task(self._save_positions())
+        self.events_task = self.bot.loop.create_task(self._publish_positions())
+        self.bot.metrics.register_collector('music', self._collect_metrics)
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        # The cog is loaded before the bot knows about its servers, so saved queues are restored on the first on_ready
+        if self.saved_queues is not None:
+            _restore_queues(self.bot, self.saved_queues)
+            self.saved_queues = None
+
+    async def _save_positions(self):
+        """Periodically saves how far into their track playing servers are, so playback can resume near where it stopped."""
+        while True:
+            await asyncio.sleep(self.bot.config["position_save_interval"])
+            for guild_id, server in self.bot.server_data.items():
+                queue = server.modules.get('music')
+                if queue and queue.player:
+                    self.bot.queue_store.mark_dirty(guild_id, queue.to_state)
+
+    async def _publish_positions(self):
+        """Periodically publishes how far into their track playing servers are, for subscribers of bot.player_events."""
+        while True:
+            await asyncio.sleep(self.bot.config["player_event_interval"])
+            for guild_id, server in self.bot.server_data.items():
+                queue = server.modules.get('music')
+                if queue and queue.player and self.bot.player_events.has_subscribers(guild_id):
+                    self.bot.player_events.publish(guild_id, 'position', queue.player_state())
+
+    def _collect_metrics(self):
+        metrics = self.bot.metrics
+        queue_length = metrics.gauge('kbot_queue_length', "Tracks queued, per server with a non-empty queue.", labels=('guild',))
+        queue_length.clear()
+        for guild_id, server in self.bot.server_data.items():
+            queue = server.modules.get('music')
+            if queue and queue.tracks:
+                queue_length.set(queue.track_count(), guild_id)
+
+        cache_lookups = metrics.counter('kbot_cache_lookups_total', "Lookups of the bot's caches since startup, by cache & result.", labels=('cache', 'result'))
+        for cache, stats in (('audio', self.bot.audio_cache.stats()), ('extract', self.bot.extractor.cache.stats()),
+                             ('resolution', self.bot.resolutions.stats())):
+            for result in ('hits', 'misses', 'merged'):
+                if result in stats:
+                    cache_lookups.set(stats[result], cache, result)
+        metrics.gauge('kbot_audio_cache_bytes', "Size of the downloaded audio cache.").set(self.bot.audio_cache.total_bytes)
+
+        extractor = self.bot.extractor.stats()
+        metrics.gauge('kbot_ytdl_active', "yt-dlp calls running.").set(extractor['active'])
+        metrics.gauge('kbot_ytdl_queued', "yt-dlp calls waiting for a worker.").set(extractor['queued'])
+        metrics.gauge('kbot_ytdl_queued_prefetches', "Prefetches waiting for a yt-dlp worker.").set(extractor['queued_prefetches'])
+        slots = self.bot.playback_slots.stats()
+        metrics.gauge('kbot_playback_slots_used', "Servers holding a playback (FFmpeg) slot.").set(slots['playing'])
+        metrics.gauge('kbot_playback_slots_waiting', "Servers waiting for a playback slot.").set(slots['waiting'])
+        metrics.gauge('kbot_player_event_subscribers', "Web API clients subscribed to player events.").set(self.bot.player_events.stats()['subscribers'])
+
+    async def cog_unload(self):
+        self.position_task.cancel()
+        self.events_task.cancel()
+        self.bot.metrics.unregister_collector('music')
+        for server in self.bot.server_data.values():
+            if 'music' in server.modules:
+                server.modules['music'].prefetcher.cancel_all()
+        self.bot.server_data.unregister_module('music')
+        self.bot.extractor.shutdown()
+        self.bot.resolutions.close()
+        await self.bot.queue_store.close()
+        await self.bot.spotify.close()
 
     @commands.Cog.listener()
     async def on_voice_state_update(self, member, before, after):
@@ -191,19 +583,17 @@ class Music(commands.Cog):
     @commands.hybrid_command()
     async def queue(self, ctx, page: int = 1):
         """Displays the song queue."""
-        server_queue_tracks = self._get_server(ctx).music.tracks
-        if len(server_queue_tracks) == 0:
+        server_queue = self._get_server(ctx).music
+        if len(server_queue) == 0:
             await ctx.send("The queue is empty.")
             return
         
-        max_pages = math.ceil(len(server_queue_tracks) / 10)
-        if 0 < page <= max_pages:
-            songs_in_page = server_queue_tracks[(page-1) * 10:page * 10]
-        else:
+        max_pages = math.ceil(len(server_queue) / 10)
+        if not 0 < page <= max_pages:
             page = max_pages
-            songs_in_page = server_queue_tracks[(page-1) * 10:page * 10]
-        queued_songs = [f"{i+1 + (page - 1)*10}. [{song['title']}](<{song['url']}>) - Added by **{song['added_by']}**" for i, song in enumerate(songs_in_page)]
-        await ctx.send(f"Current Queue: {len(server_queue_tracks)} items.\n" + "\n".join(queued_songs) + f"\nPage {page}/{max_pages}")
+        songs_in_page = server_queue.page(page, 10)
+        queued_songs = [f"{i+1 + (page - 1)*10}. [{song.title}](<{song.url}>) - {_describe_entry(song)}Added by **{song.added_by}**" for i, song in enumerate(songs_in_page)]
+        await ctx.send(f"Current Queue: {server_queue.track_count()} tracks.\n" + "\n".join(queued_songs) + f"\nPage {page}/{max_pages}")
             
     @commands.hybrid_command()
     async def pause(self, ctx):
@@ -215,6 +605,7 @@ class Music(commands.Cog):
         if ctx.voice_client.is_playing():
             await ctx.send("Playback has been paused.")
             ctx.voice_client.pause()
+            self.bot.player_events.publish(ctx.guild.id, 'pause', self._get_server(ctx).music.player_state())
         elif ctx.voice_client.is_paused():
             await ctx.send("Playback is already paused.")
         else:
@@ -230,6 +621,7 @@ class Music(commands.Cog):
         if ctx.voice_client.is_paused():
             await ctx.send("Playback has been resumed.")
             ctx.voice_client.resume()
+            self.bot.player_events.publish(ctx.guild.id, 'resume', self._get_server(ctx).music.player_state())
         else:
             await ctx.send("Playback has not been paused.")
 
@@ -244,15 +636,38 @@ class Music(commands.Cog):
             await ctx.send(e)
 
     @commands.hybrid_command()
-    async def remove(self, ctx, index):
-        """Removes a song from the queue with the given index."""
+    async def remove(self, ctx, *, indexes):
+        """Removes songs from the queue by index, eg. `remove 3`, `remove 5-120` or `remove 2 4 9-12`."""
+        server_queue = self._get_server(ctx).music
+        try:
+            ranges = _parse_ranges(indexes)
+            if len(ranges) == 1:
+                result = server_queue.remove_range(*ranges[0])
+            else:
+                result = server_queue.remove_many(index for start, stop in ranges for index in range(start, stop))
+            await ctx.send(result)
+        except Exception as e:
+            await ctx.send(e)
+
+    @commands.hybrid_command()
+    async def move(self, ctx, indexes, position: int):
+        """Moves a song, or a range of songs, to a position in the queue. Eg. `move 5-10 1`."""
         server_queue = self._get_server(ctx).music
         try:
-            result = server_queue.remove_from_queue(int(index) - 1)
+            ranges = _parse_ranges(indexes)
+            if len(ranges) != 1:
+                raise Exception("Only one song or range can be moved at a time, eg. `move 5-10 1`.")
+            result = server_queue.move_range(*ranges[0], position - 1)
             await ctx.send(result)
         except Exception as e:
             await ctx.send(e)
 
+    @commands.hybrid_command()
+    async def dedupe(self, ctx):
+        """Removes songs that are already in the queue, keeping the first of each."""
+        server_queue = self._get_server(ctx).music
+        await ctx.send(server_queue.dedupe())
+
     @commands.hybrid_command()
     async def skip(self, ctx):
         """Skips the currently playing track."""
@@ -260,6 +675,7 @@ class Music(commands.Cog):
         if ctx.voice_client:
             if ctx.voice_client.is_playing():
                 await ctx.send(f"Skipping {server_queue.now_playing['title']}.")
+                self.bot.player_events.publish(ctx.guild.id, 'skip', server_queue.player_state())
                 ctx.voice_client.stop()
             else:
                 await ctx.send("Nothing is being played.")
@@ -298,14 +714,27 @@ class Music(commands.Cog):
             server.settings['loop'] = True
             server.save_settings()
             await ctx.send("Enabled looping of the queue.")
+
+    @commands.hybrid_command()
+    async def streaming(self, ctx):
+        """Toggles streaming tracks directly instead of downloading them first."""
+        server = self._get_server(ctx)
+        if _use_streaming(self.bot, server):
+            server.settings['stream'] = False
+            server.save_settings()
+            await ctx.send("Tracks will be downloaded before playing.")
+        else:
+            server.settings['stream'] = True
+            server.save_settings()
+            await ctx.send("Tracks will be streamed as they play.")
         
     @commands.hybrid_command()
     async def search(self, ctx, *, query):
         """Searches YouTube for the given query and returns a list of results."""
         
         # Use yt_dlp to search YouTube (this does not download the video)
-        info_extracted = ytdl_search.extract_info(f"ytsearch5:{query}", download=False)
-        if 'entries' not in info_extracted:
+        info_extracted = await self.bot.extractor.extract(f"ytsearch5:{query}", guild_id=ctx.guild.id if ctx.guild else None)
+        if not info_extracted or 'entries' not in info_extracted:
             await ctx.send("Couldn't find any results.")
             return
         
@@ -338,6 +767,20 @@ class Music(commands.Cog):
             await self._stop_playback(ctx.guild)
             await ctx.send("Stopped playback.")
 
+    @commands.command()
+    @commands.is_owner()
+    async def ytdlstats(self, ctx):
+        """Owner only. Shows the yt-dlp worker pool's load."""
+        stats = self.bot.extractor.stats()
+        slots = self.bot.playback_slots.stats()
+        await ctx.send(f"yt-dlp pool ({stats['mode']}, {stats['workers']} workers, cap {stats['max_concurrency']}): "
+                       f"{stats['active']} running, {stats['queued']} queued ({stats['queued_prefetches']} prefetches) across {stats['queued_guilds']} servers.\n"
+                       f"Players: {slots['playing']} playing, {slots['waiting']} waiting, limit {slots['limit'] or 'none'}.\n"
+                       f"Completed: {stats['completed']}, failed: {stats['failed']}. "
+                       f"Wait time avg {stats['avg_wait']:.2f}s, max {stats['max_wait']:.2f}s.\n"
+                       f"Lookup cache: {stats['cache']['entries']} entries, {stats['cache']['hits']} hits, "
+                       f"{stats['cache']['misses']} misses, {stats['cache']['merged']} merged.")
+
     @commands.hybrid_command()
     async def playnext(self, ctx, *, query):
         """Adds a song to the top of the queue."""
@@ -345,8 +788,11 @@ class Music(commands.Cog):
         if 'playlist?' in query or '/playlist/' in query or '/album/' in query:
             await ctx.send("Only individual tracks can be used with `playnext`")
             return
+        queued = len(server_queue)
         await _process_query(ctx, self.bot, query)
-        server_queue.promote(len(server_queue.queue) - 1)
+        # Nothing to move if the query didn't add a track (eg. no results), or it's the only one queued
+        if len(server_queue) > 1 and len(server_queue) > queued:
+            server_queue.promote(len(server_queue) - 1)
 
     @commands.hybrid_command()
     async def jukebox(self, ctx, arg1='', arg2='', arg3=''):
@@ -405,6 +851,7 @@ class Music(commands.Cog):
     async def _stop_playback(self, guild: discord.Guild):
         server_queue = self.bot.server_data[guild.id].music
         server_queue.remove_from_queue()
+        self.bot.playback_slots.release(guild.id)
 
         if guild.voice_client:
             if guild.voice_client.is_playing() or guild.voice_client.is_paused():
@@ -416,42 +863,42 @@ class Music(commands.Cog):
             raise Exception("This command can only be used in a server.")
         return self.bot.server_data[ctx.guild.id]
 
-async def _extract_playlist_info(bot, playlist_url):
-    """Returns a list of videos from a given Youtube playlist URL."""
-    # Get playlist info without downloading the videos
-    playlist_info = await bot.loop.run_in_executor(None, lambda: ytdl_search.extract_info(playlist_url, download=False))
-
-    if 'entries' not in playlist_info:
-        return []
+async def _extract_playlist_info(bot, cursor:PlaylistCursor, guild_id=None):
+    """Returns a tuple of (videos, total) for the next page of a Youtube playlist cursor.
+    'total' is None if YouTube doesn't report the playlist's length.
+    yt-dlp has to walk every page of a playlist before the items it's asked for, so only the first page is extracted
+    on its own, to start playing quickly. The rest of the playlist is extracted once, kept on the cursor, and sliced."""
+    offset, limit = cursor.offset, cursor.page_size
+    if cursor.entries is None:
+        # Get playlist info without downloading the videos
+        items = f"{offset + 1}-{offset + limit}" if offset == 0 else f"{offset + 1}-"
+        playlist_info = await bot.extractor.extract(cursor.url, guild_id=guild_id, kind='playlist', params={'playlist_items': items})
+        if not playlist_info or 'entries' not in playlist_info:
+            return [], 0
+        entries = list(playlist_info['entries'])
+        total = playlist_info.get('playlist_count')
+        if offset == 0:
+            if total is None and len(entries) < limit:
+                total = len(entries)
+        else:
+            cursor.entries = entries
+            total = offset + len(entries)
+    else:
+        entries, total = cursor.entries, cursor.total
+    page = entries[:limit]
+    if cursor.entries is not None:
+        cursor.entries = entries[limit:]
 
     # Extract video titles and URLs from the playlist info, filtering out privated & deleted videos
     videos = [
         {'title': entry['title'], 'url': entry['url']}
-        for entry in playlist_info['entries'] 
-        if entry['title'] not in ('[Private video]', '[Deleted video]')
+        for entry in page
+        if entry and entry['title'] not in ('[Private video]', '[Deleted video]')
     ]
-    return videos
-
-def _get_spotify_token(client_id, client_secret):
-    """Obtain an access token from Spotify's API."""
-    auth_url = 'https://accounts.spotify.com/api/token'
-
-    # Request based on Client Credentials Flow from Spotify's documentation
-    response = requests.post(auth_url, {
-        'grant_type': 'client_credentials',
-        'client_id': client_id,
-        'client_secret': client_secret,
-    })
-    response_data = response.json()
-    return response_data["access_token"]
-
-def _parse_spotify_link(bot, url):
-    """Returns a list of tracks from a given Spotify playlist, album, or track."""
-    token = _get_spotify_token(bot.config["spotify_id"], bot.config["spotify_secret"])
-    headers = {
-        "Authorization": f"Bearer {token}"
-    }
+    return videos, total
 
+async def _parse_spotify_link(bot, url, offset:int=0, limit:int=50):
+    """Returns a tuple of (tracks, total) for a given Spotify track, or for a page of a Spotify playlist or album."""
     if "track" in url:
         # Extract ID from link
         match = re.search(r"track/(\w+)", url)
@@ -460,35 +907,18 @@ def _parse_spotify_link(bot, url):
         track_id = match.group(1)
 
         # Get track's details from Spotify's API
-        track_url = f"https://api.spotify.com/v1/tracks/{track_id}"
-        response = requests.get(track_url, headers=headers)
-        track_data = response.json()
+        track_data = await bot.spotify.get_track(track_id)
+        tracks, total = [track_data], 1
 
-        artist = track_data['artists'][0]['name']  # We take the name of the first artist
-        title = track_data['name']
-        return [f"{artist}, {title}"]
-    
     elif "playlist" in url:
         # Extract playlist ID from link
         match = re.search(r"playlist/(\w+)", url)
         if not match:
             raise Exception("Invalid Spotify playlist link!")
         playlist_id = match.group(1)
-        
-        # Get tracks from the playlist, iterating if theres multiple pages
-        tracks = []
-        playlist_url = f"https://api.spotify.com/v1/playlists/{playlist_id}/tracks"
 
-        while playlist_url:
-            response = requests.get(playlist_url, headers=headers)
-            playlist_data = response.json()
-            
-            for item in playlist_data['items']:
-                artist = item['track']['artists'][0]['name']
-                title = item['track']['name']
-                tracks.append(f"{artist}, {title}")
-            playlist_url = playlist_data['next']
-        return tracks
+        # Get a page of tracks from the playlist
+        tracks, total = await bot.spotify.get_playlist_page(playlist_id, offset, limit)
 
     elif "album" in url:
         # Extract album ID from link
@@ -496,22 +926,16 @@ def _parse_spotify_link(bot, url):
         if not match:
             raise Exception("Invalid Spotify album link!")
         album_id = match.group(1)
-        
-        # Get tracks from the album
-        album_url = f"https://api.spotify.com/v1/albums/{album_id}/tracks"
-        response = requests.get(album_url, headers=headers)
-        album_data = response.json()
-        
-        tracks = []
-        for item in album_data['items']:
-            artist = item['artists'][0]['name']
-            title = item['name']
-            tracks.append(f"{artist}, {title}")
-        return tracks
+
+        # Get a page of tracks from the album
+        tracks, total = await bot.spotify.get_album_page(album_id, offset, limit)
 
     else:
         raise Exception("Invalid Spotify link!")
 
+    # We take the name of the first artist
+    return [f"{track['artists'][0]['name']}, {track['name']}" for track in tracks], total
+
 async def _join_voice_channel(ctx):
     """Attempts to join a voice channel in the given 'context'.
     May raise an error if the author isn't in a voice channel, or if the bot has insufficient permissions to join.
@@ -541,95 +965,247 @@ async def _process_query(ctx, bot, query):
     # Check if the query is a URL
     if not _is_url(query):
         # If it's not a URL, treat it as a search query
-        url = _get_youtube_url(query)
+        url = await _get_youtube_url(bot, query, ctx.guild.id)
         if url:
             query = url
         else:
-            ctx.send(f"No results found for {query}")
+            await ctx.send(f"No results found for {query}")
             return
         
     # From here, query should be validated as a URL
     if 'spotify' in query:
         try:
-            tracks = _parse_spotify_link(bot, query)
-            for track in tracks:
-                server_queue.enqueue(title=track, url=query, track_type="spotify", added_by=ctx.author.name)
-            await ctx.send(f"{len(tracks)} tracks have been added to the queue!")
+            if '/playlist/' in query or '/album/' in query:
+                # Playlists are loaded a page at a time, as playback reaches them
+                cursor = PlaylistCursor(title="Spotify playlist" if '/playlist/' in query else "Spotify album", url=query,
+                                        track_type="spotify_playlist", added_by=ctx.author.name, page_size=50)
+                await _enqueue_playlist(bot, ctx.guild.id, cursor)
+                await ctx.send(f"{cursor.total} tracks have been added to the queue!")
+            else:
+                tracks, total = await _parse_spotify_link(bot, query)
+                server_queue.enqueue_many([Track(title, query, "spotify", ctx.author.name) for title in tracks])
+                await ctx.send(f"{len(tracks)} tracks have been added to the queue!")
         except Exception as e:
             await ctx.send(e)
         return
     elif 'playlist?' in query:
-        videos = await _extract_playlist_info(bot, query)
-        for video in videos:
-            server_queue.enqueue(title=video['title'], url=video['url'], track_type="youtube", added_by=ctx.author.name)
-        await ctx.send(f"{len(videos)} videos have been added to the queue!")
+        cursor = PlaylistCursor(title="YouTube playlist", url=query, track_type="youtube_playlist", added_by=ctx.author.name, page_size=100)
+        await _enqueue_playlist(bot, ctx.guild.id, cursor)
+        await ctx.send(f"{cursor.total if cursor.total is not None else 'Many'} videos have been added to the queue!")
         return
     else:
         # At this point, the url isn't a Spotify link or a Youtube playlist, but is a URL
-        player = await YTDLSource.from_url(query, loop=bot.loop)
-        server_queue.enqueue(title=player.title, url=query, track_type="unknown url", added_by=ctx.author.name)
-        await ctx.send(f"**{player.title}** has been added to the queue!")
+        # Only the title is needed here, so don't download anything yet
+        data = await YTDLSource.extract(query, extractor=bot.extractor, guild_id=ctx.guild.id, stream=True)
+        server_queue.enqueue(title=data.get('title'), url=query, track_type="unknown url", added_by=ctx.author.name)
+        await ctx.send(f"**{data.get('title')}** has been added to the queue!")
     
+async def _enqueue_playlist(bot, guild_id, cursor:PlaylistCursor):
+    """Adds a playlist cursor to the queue, and waits for its first page to load."""
+    bot.server_data[guild_id].music.enqueue_cursor(cursor)
+    await asyncio.shield(_load_playlist(bot, guild_id, cursor))
+    if cursor.error:
+        raise cursor.error
+
+def _load_playlist(bot, guild_id, cursor:PlaylistCursor):
+    """Starts loading the next page of a playlist cursor, unless it's already loading. Returns the loading task."""
+    if cursor.loading is None:
+        cursor.loading = bot.loop.create_task(_load_playlist_page(bot, guild_id, cursor))
+    return cursor.loading
+
+async def _load_playlist_page(bot, guild_id, cursor:PlaylistCursor):
+    server_queue = bot.server_data[guild_id].music
+    try:
+        if cursor.track_type == 'spotify_playlist':
+            page = cursor.pages.pop(cursor.offset, None) or _parse_spotify_link(bot, cursor.url, cursor.offset, cursor.page_size)
+            titles, total = await page
+            tracks = [Track(title, cursor.url, "spotify", cursor.added_by) for title in titles]
+        else:
+            videos, total = await _extract_playlist_info(bot, cursor, guild_id)
+            tracks = [Track(video['title'], video['url'], "youtube", cursor.added_by) for video in videos]
+        cursor.total = total
+        cursor.offset += cursor.page_size
+        exhausted = cursor.remaining == 0
+        if cursor.track_type == 'spotify_playlist' and not exhausted:
+            _read_ahead(bot, cursor)
+    except Exception as e:
+        # Drop the rest of the playlist, rather than retrying it forever
+        print(f"Couldn't load the next page of {cursor.url}: {e}")
+        cursor.error = e
+        for page in cursor.pages.values():
+            page.cancel()
+        cursor.pages.clear()
+        tracks, exhausted = [], True
+    finally:
+        cursor.loading = None
+    server_queue.expand(cursor, tracks, exhausted)
+
+def _read_ahead(bot, cursor:PlaylistCursor):
+    """Starts fetching the next few pages of a Spotify cursor concurrently, so they're ready by the time playback reaches them.
+    Fetches at most SPOTIFY_READ_AHEAD pages ahead, and SpotifyClient caps how many requests run at once."""
+    offset = cursor.offset
+    for _ in range(bot.config["spotify_read_ahead"]):
+        if offset >= cursor.total:
+            break
+        if offset not in cursor.pages:
+            cursor.pages[offset] = bot.loop.create_task(_parse_spotify_link(bot, cursor.url, offset, cursor.page_size))
+        offset += cursor.page_size
+
+def _parse_ranges(text):
+    """Parses 1-indexed queue positions like '5', '5-120' or '2 4 9-12' into a list of 0-indexed (start, stop) ranges."""
+    ranges = []
+    for part in re.split(r"[\s,]+", text.strip()):
+        if not part:
+            continue
+        first, _, last = part.partition('-')
+        if not first.isdigit() or (last and not last.isdigit()):
+            raise Exception(f"`{part}` isn't a queue position or range, eg. `5` or `5-120`.")
+        first, last = int(first), int(last or first)
+        if first < 1 or last < first:
+            raise Exception(f"`{part}` isn't a valid range.")
+        ranges.append((first - 1, last))
+    if not ranges:
+        raise Exception("No queue positions given.")
+    return ranges
+
+def _describe_entry(track):
+    """Extra text for a queue entry in the queue command."""
+    if isinstance(track, PlaylistCursor):
+        return f"{track.remaining if track.remaining is not None else 'More'} tracks not loaded yet - "
+    return ""
+
 def _is_url(string):
     """Returns True if the given string is a valid URL."""
     url_pattern = re.compile(r"http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+")
     return re.match(url_pattern, string) is not None
 
-def _file_cleanup(filename_base):
-    """Deletes a played file from ./downloads/.
-    This doesn't always work, perhaps exotic filenames or the file is still being accessed??"""
-    search_pattern = os.path.join('downloads', f"{filename_base}.*")
-    matching_files = glob.glob(search_pattern)
-
-    for file in matching_files:
-        os.remove(file)
-
 async def _song_finished(ctx, bot, error, player):
     """Called when a song finishes playing"""
+    if bot.watchdog:
+        bot.watchdog.track('next song', ctx.guild.id)
     server_queue = bot.server_data[ctx.guild.id].music
-    song_title = player.title
     player.cleanup()
-    _file_cleanup(song_title)
+    bot.audio_cache.release(player.data)
     if error:
         print(f"Player error: {error}")
+    bot.player_events.publish(ctx.guild.id, 'track_end', {'title': player.title, 'position': round(player.position, 1),
+                                                          'error': str(error) if error else None})
 
     # Logic for servers who have 'loop' enabled.
     if bot.server_data[ctx.guild.id].settings['loop']:
         async def loop_song():
-            server_queue.enqueue(title=player.title, url=player.data['url'], track_type="looped_queue", added_by="ctx.me.name")
+            server_queue.enqueue(title=player.title, url=player.data['original_url'], track_type="looped_queue", added_by="ctx.me.name")
             await _play_next_song(ctx, bot)
         await loop_song()
     else:
         await _play_next_song(ctx, bot)
 
-def _get_youtube_url(query):
-    """Returns the URL of the first search result of a given Youtube query."""
-    search_result = ytdl_search.extract_info(f"ytsearch5:{query}", download=False)
+async def _get_youtube_url(bot, query, guild_id=None, request=None):
+    """Returns the URL of the first search result of a given Youtube query.
+    Previously resolved queries are answered from bot.resolutions without searching."""
+    video_url = bot.resolutions.get(query)
+    if video_url:
+        return video_url
+
+    search_result = await bot.extractor.extract(f"ytsearch5:{query}", guild_id=guild_id, request=request)
     if search_result and 'entries' in search_result and len(search_result['entries']) > 0:
         # Get the URL of the first search result
         video_url = search_result['entries'][0]['url']
+        bot.resolutions.put(query, video_url)
         return video_url
     else:
         print(f"No results found for '{query}'")
         return None
 
+async def _resolve_track(bot, track, guild_id=None, request=None):
+    """Finds the playable URL of a queued track & downloads it. Returns a tuple of (url, info dict).
+    'request' sets the priority of the extractions, see ExtractionService."""
+    if track.track_type != 'spotify':
+        return await _load_url(bot, track.url, guild_id, request)
+
+    was_cached = track.title in bot.resolutions
+    url = await _get_youtube_url(bot, track.title, guild_id, request)
+    if not url:
+        raise Exception(f"No results found for {track.title}")
+    try:
+        return await _load_url(bot, url, guild_id, request)
+    except Exception as e:
+        if not was_cached:
+            raise
+        # The video we resolved to last time may have been taken down, so search again
+        print(f"Cached result for {track.title} is unavailable, searching again: {e}")
+        bot.resolutions.invalidate(track.title)
+        url = await _get_youtube_url(bot, track.title, guild_id, request)
+        if not url:
+            raise Exception(f"No results found for {track.title}")
+        return await _load_url(bot, url, guild_id, request)
+
+async def _load_url(bot, url, guild_id=None, request=None):
+    """Streams or downloads a URL, depending on the server's settings. Returns a tuple of (url, info dict)."""
+    if _use_streaming(bot, bot.server_data[guild_id]):
+        try:
+            data = await YTDLSource.extract(url, extractor=bot.extractor, guild_id=guild_id, stream=True, request=request)
+            if YTDLSource.is_streamable(data):
+                return url, data
+        except Exception as e:
+            print(f"Couldn't stream {url}, downloading instead: {e}")
+
+    data = await YTDLSource.extract(url, extractor=bot.extractor, cache=bot.audio_cache, guild_id=guild_id, request=request)
+    return url, data
+
+def _use_streaming(bot, server):
+    """Returns True if a server streams its tracks, falling back to the deployment's PLAYBACK_MODE."""
+    return server.settings.get('stream', bot.config["playback_mode"] == 'stream')
+
 async def _play_next_song(ctx, bot):
     """Called when a song should start playing. Calls song_finished() when the track finishes playing or is skipped."""
     server_queue = bot.server_data[ctx.guild.id].music
+    if server_queue.starting:
+        # Another call is already starting a track, eg. 'play' was used again while the server waits for a playback slot.
+        # Starting another would dequeue a second track for the same voice client, so it stays queued & plays next instead.
+        return
+    # The track is dequeued long before it plays (eg. while it downloads), so mark the server as busy until then
+    server_queue.starting = True
+    try:
+        await _start_next_song(ctx, bot, server_queue)
+    finally:
+        server_queue.starting = False
+
+async def _start_next_song(ctx, bot, server_queue):
+    requested_at = time.perf_counter()
+
+    # If the next entry is an unloaded playlist, load its next page into the queue first
+    next_entries = server_queue.peek(1)
+    while next_entries and isinstance(next_entries[0], PlaylistCursor):
+        await asyncio.shield(_load_playlist(bot, ctx.guild.id, next_entries[0]))
+        next_entries = server_queue.peek(1)
+
     song_info = server_queue.next_song()  # Dequeue the next song & return its data
 
     if not song_info:
         # Queue is empty, so clear now playing.
-        server_queue.now_playing = {}
+        server_queue.set_now_playing(None, None, {})
         return
     
-    title = song_info['title']
-    if song_info['track_type'] == 'spotify':
-        url = _get_youtube_url(song_info['title'])
-    else:
-        url = song_info['url']
+    title = song_info.title
+    try:
+        url, data = await _resolve_next_song(ctx, bot, song_info)
+    except Exception:
+        # Nothing is going to play, so let another server have this one's playback slot
+        bot.playback_slots.release(ctx.guild.id)
+        raise
+
+    # Every playing server runs an FFmpeg process, so servers beyond FFMPEG_LIMIT wait for another to finish
+    on_queued = _queue_notice(ctx, bot, lambda position: f"Every player is busy right now. **{title}** is number {position} in line, "
+                                                         "and will start when one is free.")
+    if not await bot.playback_slots.acquire(ctx.guild.id, on_queued) or not ctx.voice_client:
+        # Playback was stopped while waiting
+        bot.playback_slots.release(ctx.guild.id)
+        bot.audio_cache.release(data)
+        return
 
-    player = await YTDLSource.from_url(url, loop=bot.loop)
+    player = YTDLSource.from_data(data, passthrough=bot.config["opus_passthrough"], start_at=server_queue.take_resume_position(song_info))
+    _time_first_audio(ctx, bot, player, requested_at)
 
     async def after_callback(ctx, e, player):
         await _song_finished(ctx, bot, e, player)
@@ -642,29 +1218,199 @@ async def _play_next_song(ctx, bot):
     async def play_song():
         clen = str(player.data.get('duration')) 
         player.url += '&range=0-' + clen # This is a workaround for Youtube throttling
-        ctx.voice_client.play(player, after=after_lambda)
-        server_queue.now_playing = {
+        try:
+            ctx.voice_client.play(player, after=after_lambda)
+        except Exception:
+            # Nothing will call after_lambda, so unpin the file & give back the playback slot here
+            player.cleanup()
+            bot.audio_cache.release(data)
+            bot.playback_slots.release(ctx.guild.id)
+            raise
+        server_queue.text_channel_id = ctx.channel.id
+        server_queue.voice_channel_id = ctx.voice_client.channel.id
+        server_queue.set_now_playing(song_info, player, {
             'title': title,
             'url': url,
             'length': timedelta(seconds=player.data.get('duration'))
-        }
+        })
         await ctx.send(f"Playing: **{title}**", delete_after=60, silent=True)
     await play_song()
 
+async def _resolve_next_song(ctx, bot, song_info):
+    """Returns (url, info dict) of a track that was just dequeued, from its prefetch if there is one.
+    If the download has to wait for the extraction workers, the channel is told where it is in line."""
+    on_queued = _queue_notice(ctx, bot, lambda position: f"**{song_info.title}** is number {position} in the download queue, "
+                                                         "and will play as soon as it's ready.")
+    prefetched = bot.server_data[ctx.guild.id].music.prefetcher.claim(song_info)
+    if not prefetched:
+        return await _resolve_track(bot, song_info, ctx.guild.id, ExtractionRequest(on_queued=on_queued))
+
+    task, request = prefetched
+    # The server is now waiting on this track, so it goes ahead of every prefetch
+    request.on_queued = on_queued
+    position = bot.extractor.promote(request)
+    if position:
+        on_queued(position)
+    try:
+        return await task
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        # The prefetch failed, so try once more before giving up on the track
+        print(f"Prefetch of {song_info.title} failed: {e}")
+        return await _resolve_track(bot, song_info, ctx.guild.id, ExtractionRequest(on_queued=on_queued))
+
+def _queue_notice(ctx, bot, message):
+    """Returns an 'on_queued(position)' callback that tells the channel, once, where a track is in line."""
+    sent = False
+
+    def on_queued(position):
+        nonlocal sent
+        if not sent:
+            sent = True
+            bot.loop.create_task(ctx.send(message(position), delete_after=60, silent=True))
+    return on_queued
+
+def _time_first_audio(ctx, bot, player, requested_at):
+    """Records how long the player takes to produce audio: from the play command for its first track,
+    otherwise from when the next track was requested."""
+    if getattr(ctx, 'invoked_at', None) is not None and not getattr(ctx, 'audio_measured', False):
+        ctx.audio_measured = True
+        started, source = ctx.invoked_at, 'command'
+    else:
+        started, source = requested_at, 'queue'
+    histogram = bot.metrics.histogram('kbot_time_to_first_audio_seconds', "Time until a track's first audio frame, from the play command or the queue.",
+                                      labels=('source',))
+
+    def on_first_frame():
+        bot.loop.call_soon_threadsafe(histogram.observe, time.perf_counter() - started, source)
+    player.on_first_frame = on_first_frame
+
+class _ResumeContext():
+    """Stands in for a command's Context when playback is resumed after a restart."""
+    def __init__(self, guild:discord.Guild, channel):
+        self.guild = guild
+        self.channel = channel
+
+    @property
+    def voice_client(self):
+        return self.guild.voice_client
+
+    async def send(self, *args, **kwargs):
+        return await self.channel.send(*args, **kwargs)
+
+async def _resume_playback(bot, guild:discord.Guild):
+    """Rejoins the voice channel a server was playing in before a restart, and carries on with its queue."""
+    if bot.watchdog:
+        bot.watchdog.track('resume playback', guild.id)
+    server_queue = bot.server_data[guild.id].music
+    voice_channel = guild.get_channel(server_queue.voice_channel_id)
+    text_channel = guild.get_channel(server_queue.text_channel_id)
+    if not voice_channel or not text_channel or not any(not member.bot for member in voice_channel.members):
+        return
+    try:
+        await voice_channel.connect()
+        await _play_next_song(_ResumeContext(guild, text_channel), bot)
+    except Exception as e:
+        print(f"Couldn't resume playback in {guild.name}: {e}")
+
+def _init_queue(bot, guild_id):
+    """Creates a server's Queue, along with its Prefetcher. Its state is saved to bot.queue_store whenever it changes.
+    Called the first time 'bot.server_data[guild_id].music' is accessed."""
+    queue = Queue()
+    queue.prefetcher = Prefetcher(bot, guild_id, queue, depth=bot.config["prefetch_depth"])
+    queue.add_listener(lambda event, track: bot.queue_store.mark_dirty(guild_id, queue.to_state))
+    queue.add_listener(lambda event, track: _publish_queue_event(bot, guild_id, queue, event, track))
+    # The server stopped playing, so its FFmpeg slot is free for another
+    queue.add_listener(lambda event, track: bot.playback_slots.release(guild_id) if event == 'stop' else None)
+    return queue
+
+def _publish_queue_event(bot, guild_id, queue, event, track):
+    """Forwards a change to a server's Queue to bot.player_events."""
+    if not bot.player_events.has_subscribers(guild_id):
+        return
+    if event == 'play':
+        bot.player_events.publish(guild_id, 'track_start', queue.player_state())
+    elif event == 'stop':
+        bot.player_events.publish(guild_id, 'player_stop')
+    else:
+        bot.player_events.publish(guild_id, 'queue', {'change': event, 'title': track.title if track else None,
+                                                      'length': len(queue), 'tracks': queue.track_count()})
+
+def _restore_queues(bot, saved_queues):
+    """Loads the queues saved by bot.queue_store, and resumes their playback if RESUME_PLAYBACK is set."""
+    for guild_id, state in saved_queues.items():
+        guild = bot.get_guild(guild_id)
+        if not guild:
+            continue
+        print(f"Restoring queue for {guild.name}")
+        # If the bot is still connected (eg. the cog was reloaded), the interrupted track is still playing
+        bot.server_data[guild_id].music.load_state(state, resume_current=guild.voice_client is None)
+        if bot.config["resume_playback"] and guild.voice_client is None:
+            bot.loop.create_task(_resume_playback(bot, guild))
+
 async def setup(bot):
     print("Loading Music extension...")
 
     # Initialize Spotify API variables
     bot.config["spotify_id"] = os.environ.get('SPOTIFY_ID')
     bot.config["spotify_secret"] = os.environ.get('SPOTIFY_SECRET')
+    # Pages of a Spotify playlist or album fetched ahead of playback, at once
+    bot.config["spotify_read_ahead"] = int(os.environ.get('SPOTIFY_READ_AHEAD', 2))
+
+    # Initialize playback variables. YTDL_EXECUTOR may be 'thread' or 'process', PLAYBACK_MODE may be 'download' or 'stream'.
+    bot.config["ytdl_workers"] = int(os.environ.get('YTDL_WORKERS', 4))
+    bot.config["ytdl_concurrency"] = int(os.environ.get('YTDL_CONCURRENCY', bot.config["ytdl_workers"]))
+    bot.config["ytdl_executor"] = os.environ.get('YTDL_EXECUTOR', 'thread')
+    bot.config["playback_mode"] = os.environ.get('PLAYBACK_MODE', 'download')
+    bot.config["opus_passthrough"] = os.environ.get('OPUS_PASSTHROUGH', '').lower() in ('1', 'true', 'yes')
+    bot.config["prefetch_depth"] = int(os.environ.get('PREFETCH_DEPTH', 2))
+    bot.config["audio_cache_bytes"] = int(os.environ.get('AUDIO_CACHE_BYTES', 2 * 1024**3))
+    # launcher.py gives each worker process its own directory, so workers never evict each other's files
+    bot.config["audio_cache_dir"] = os.environ.get('AUDIO_CACHE_DIR', 'downloads')
+    bot.config["extract_cache_size"] = int(os.environ.get('EXTRACT_CACHE_SIZE', 1024))
+    bot.config["extract_cache_ttl"] = float(os.environ.get('EXTRACT_CACHE_TTL', 600))
+    bot.config["queue_save_interval"] = float(os.environ.get('QUEUE_SAVE_INTERVAL', 1))
+    bot.config["position_save_interval"] = float(os.environ.get('POSITION_SAVE_INTERVAL', 10))
+    bot.config["resume_playback"] = os.environ.get('RESUME_PLAYBACK', '').lower() in ('1', 'true', 'yes')
+    bot.config["resolution_ttl"] = float(os.environ.get('RESOLUTION_TTL_DAYS', 30)) * 24 * 3600
+    bot.config["player_event_interval"] = float(os.environ.get('PLAYER_EVENT_INTERVAL', 5))
+    # Most servers that can play at once, ie. FFmpeg processes. Unset or 0 for no limit
+    bot.config["ffmpeg_limit"] = int(os.environ.get('FFMPEG_LIMIT', 0)) or None
+
+    if (not bot.config['spotify_id'] or not bot.config['spotify_secret']):
+        raise Exception("spotify_id or spotify_secret empty")
 
     if not os.path.exists('servers/music'):
         os.makedirs('servers/music')
 
-    for guild in bot.guilds:
-        print(f"Initializing queue for {guild.name}")
-        bot.server_data[guild.id].music = Queue()
-
-    if (not bot.config['spotify_id'] or not bot.config['spotify_secret']):
-        raise Exception("spotify_id or spotify_secret empty")
-    await bot.add_cog(Music(bot))
\ No newline at end of file
+    bot.extractor = ExtractionService(max_workers=bot.config["ytdl_workers"],
+                                      max_concurrency=bot.config["ytdl_concurrency"],
+                                      use_processes=bot.config["ytdl_executor"] == 'process',
+                                      cache_size=bot.config["extract_cache_size"],
+                                      cache_ttl=bot.config["extract_cache_ttl"],
+                                      metrics=bot.metrics)
+    os.makedirs(bot.config["audio_cache_dir"], exist_ok=True)
+    bot.audio_cache = AudioCache(bot.config["audio_cache_dir"], max_bytes=bot.config["audio_cache_bytes"])
+    bot.resolutions = ResolutionCache('servers/music/resolutions.db', ttl=bot.config["resolution_ttl"])
+    bot.spotify = SpotifyClient(bot.config["spotify_id"], bot.config["spotify_secret"])
+    # Kept across reloads of the cog, so the web API's subscribers stay connected
+    if not hasattr(bot, 'player_events'):
+        bot.player_events = EventBus()
+    # Also kept across reloads, as servers that are playing hold their slots
+    if not hasattr(bot, 'playback_slots'):
+        bot.playback_slots = PlaybackSlots()
+    bot.playback_slots.limit = bot.config["ffmpeg_limit"]
+
+    bot.queue_store = GuildStore('servers/music/queues.db', 'queues', interval=bot.config["queue_save_interval"])
+    saved_queues = bot.queue_store.load()
+    bot.queue_store.start()
+
+    # Queues are created as servers use them. Only servers that had something queued are restored.
+    bot.server_data.register_module('music', lambda server: _init_queue(bot, server.id))
+    if bot.is_ready():
+        # The cog was reloaded
+        _restore_queues(bot, saved_queues)
+        await bot.add_cog(Music(bot))
+    else:
+        await bot.add_cog(Music(bot, saved_queues))
\ No newline at end of file
@@ -0,0 +1,152 @@
+from itertools import chain, islice
+
+
+class BlockList():
+    """A list stored as a list of smaller lists ('blocks'), for queues that can hold tens of thousands of tracks.
+    Finding an index skips over whole blocks, so indexing, inserting & deleting cost O(n / block_size + block_size)
+    instead of a plain list's O(n). Inserting or deleting a run of items costs about the same as a single one.
+    Supports the parts of the list & deque interfaces that Queue uses. Slices must have a step of 1."""
+    def __init__(self, items=(), block_size:int=2048):
+        self.block_size = block_size
+        self._blocks = []
+        self._len = 0
+        self.extend(items)
+
+    def __len__(self):
+        return self._len
+
+    def __bool__(self):
+        return self._len > 0
+
+    def __iter__(self):
+        return chain.from_iterable(self._blocks)
+
+    def __repr__(self):
+        return f"BlockList({list(self)!r})"
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop = self._slice_bounds(index)
+            if start >= stop:
+                return []
+            number, offset = self._locate(start)
+            return list(islice(chain(self._blocks[number][offset:], chain.from_iterable(self._blocks[number + 1:])), stop - start))
+        number, offset = self._locate(self._index(index))
+        return self._blocks[number][offset]
+
+    def __delitem__(self, index):
+        if isinstance(index, slice):
+            start, stop = self._slice_bounds(index)
+            if start < stop:
+                self._delete(start, stop)
+        else:
+            self.pop(index)
+
+    def append(self, item):
+        if not self._blocks or len(self._blocks[-1]) >= self.block_size:
+            self._blocks.append([])
+        self._blocks[-1].append(item)
+        self._len += 1
+
+    def extend(self, items):
+        items = list(items)
+        self._len += len(items)
+        if self._blocks and len(self._blocks[-1]) < self.block_size:
+            room = self.block_size - len(self._blocks[-1])
+            self._blocks[-1].extend(items[:room])
+            items = items[room:]
+        self._blocks.extend(items[i:i + self.block_size] for i in range(0, len(items), self.block_size))
+
+    def appendleft(self, item):
+        self.insert(0, item)
+
+    def insert(self, index:int, item):
+        self.insert_many(index, (item,))
+
+    def insert_many(self, index:int, items):
+        """Inserts 'items' in order, so that the first of them ends up at 'index'."""
+        items = list(items)
+        if index < 0:
+            index = max(self._len + index, 0)
+        if index >= self._len:
+            self.extend(items)
+            return
+        number, offset = self._locate(index)
+        block = self._blocks[number]
+        block[offset:offset] = items
+        self._len += len(items)
+        if len(block) > self.block_size * 2:
+            self._blocks[number:number + 1] = [block[i:i + self.block_size] for i in range(0, len(block), self.block_size)]
+
+    def pop(self, index:int=-1):
+        number, offset = self._locate(self._index(index))
+        block = self._blocks[number]
+        item = block.pop(offset)
+        self._len -= 1
+        self._shrunk(number)
+        return item
+
+    def popleft(self):
+        if not self._len:
+            raise IndexError("pop from an empty BlockList")
+        block = self._blocks[0]
+        item = block.pop(0)
+        self._len -= 1
+        if not block:
+            del self._blocks[0]
+        return item
+
+    def _index(self, index):
+        if index < 0:
+            index += self._len
+        if not 0 <= index < self._len:
+            raise IndexError("BlockList index out of range")
+        return index
+
+    def _slice_bounds(self, index):
+        start, stop, step = index.indices(self._len)
+        if step != 1:
+            raise ValueError("BlockList slices must have a step of 1")
+        return start, stop
+
+    def _locate(self, index):
+        """Returns (block number, offset in the block) of an index in range. Scans from whichever end is nearer."""
+        if index < self._len // 2:
+            for number, block in enumerate(self._blocks):
+                if index < len(block):
+                    return number, index
+                index -= len(block)
+        else:
+            index -= self._len
+            for number in range(len(self._blocks) - 1, -1, -1):
+                index += len(self._blocks[number])
+                if index >= 0:
+                    return number, index
+        raise IndexError("BlockList index out of range")
+
+    def _delete(self, start, stop):
+        number, offset = self._locate(start)
+        count = stop - start
+        self._len -= count
+        while count:
+            block = self._blocks[number]
+            taken = min(count, len(block) - offset)
+            del block[offset:offset + taken]
+            count -= taken
+            offset = 0
+            if block:
+                number += 1
+            else:
+                del self._blocks[number]
+        self._shrunk(number - 1)
+
+    def _shrunk(self, number):
+        """Drops a block that was emptied, or merges a small one into the next, so lookups don't slow down over time."""
+        if not 0 <= number < len(self._blocks):
+            return
+        block = self._blocks[number]
+        if not block:
+            del self._blocks[number]
+        elif len(block) < self.block_size // 4 and number + 1 < len(self._blocks) \
+                and len(block) + len(self._blocks[number + 1]) <= self.block_size:
+            block.extend(self._blocks.pop(number + 1))
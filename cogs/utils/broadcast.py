@@ -0,0 +1,123 @@
+import asyncio
+import secrets
+import time
+from collections import OrderedDict
+
+import discord
+
+
+class BroadcastJob():
+    """A batch of messages to send, and the status of each. Item statuses are 'pending', 'sent', 'failed',
+    or 'not_found' if the channel isn't one the bot (or this worker process, see launcher.py) can see.
+    The job's status is 'queued', 'running', then 'done', or 'cancelled' if the bot shut down before it finished."""
+    def __init__(self, messages:list):
+        self.id = secrets.token_hex(8)
+        self.created_at = time.time()
+        self.finished_at = None
+        self.status = 'queued'
+        self.items = [{'channel_id': int(message['channel_id']), 'status': 'pending', 'message_id': None, 'error': None}
+                      for message in messages]
+        self.contents = [message['message'] for message in messages]
+
+    def to_dict(self):
+        counts = {}
+        for item in self.items:
+            counts[item['status']] = counts.get(item['status'], 0) + 1
+        return {
+            'job_id': self.id,
+            'status': self.status,
+            'created_at': self.created_at,
+            'finished_at': self.finished_at,
+            'total': len(self.items),
+            'counts': counts,
+            'items': self.items,
+        }
+
+
+class BroadcastScheduler():
+    """Sends the messages of BroadcastJobs without running into Discord's rate limits.
+    Messages to the same channel (one rate limit bucket) are sent one at a time, in order. Across channels, at most
+    'max_concurrency' sends are in flight, and sends start at most 'rate' times per second, under the global limit.
+    discord.py still handles any 429 that gets through. Finished jobs are kept for 'retention' seconds."""
+    def __init__(self, bot, max_concurrency:int=8, rate:float=40, retention:float=3600):
+        self.bot = bot
+        self.rate = rate
+        self.retention = retention
+        self.jobs = OrderedDict()  # job ID -> BroadcastJob, oldest first
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._next_send = 0.0
+        self._tasks = set()
+
+    def submit(self, messages:list):
+        """Queues a list of {'channel_id', 'message'} dicts & returns their BroadcastJob."""
+        self._expire()
+        job = BroadcastJob(messages)
+        self.jobs[job.id] = job
+        task = asyncio.get_running_loop().create_task(self._run(job))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return job
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def cancel_all(self):
+        for task in self._tasks:
+            task.cancel()
+
+    async def _run(self, job):
+        job.status = 'running'
+        by_channel = {}
+        for index, item in enumerate(job.items):
+            by_channel.setdefault(item['channel_id'], []).append(index)
+        try:
+            await asyncio.gather(*[self._send_to_channel(job, channel_id, indexes) for channel_id, indexes in by_channel.items()])
+            job.status = 'done'
+        except asyncio.CancelledError:
+            job.status = 'cancelled'
+            raise
+        finally:
+            if job.status == 'running':
+                # Something other than a send failed, so don't leave the job running forever
+                job.status = 'done'
+            job.finished_at = time.time()
+
+    async def _send_to_channel(self, job, channel_id, indexes):
+        channel = self.bot.get_channel(channel_id)
+        for index in indexes:
+            item = job.items[index]
+            if channel is None:
+                item['status'] = 'not_found'
+                item['error'] = 'Channel not found'
+                continue
+            if not isinstance(channel, discord.abc.Messageable):
+                # Eg. a category or forum channel
+                item['status'] = 'failed'
+                item['error'] = "Channel can't receive messages"
+                continue
+            async with self._semaphore:
+                await self._throttle()
+                try:
+                    message = await channel.send(job.contents[index])
+                    item['status'] = 'sent'
+                    item['message_id'] = message.id
+                except Exception as e:
+                    item['status'] = 'failed'
+                    item['error'] = str(e)
+
+    async def _throttle(self):
+        # Spaces the start of sends 1/rate seconds apart
+        now = time.monotonic()
+        start = max(now, self._next_send)
+        self._next_send = start + 1 / self.rate
+        if start > now:
+            await asyncio.sleep(start - now)
+
+    def _expire(self):
+        cutoff = time.time() - self.retention
+        for job_id in list(self.jobs):
+            job = self.jobs[job_id]
+            # Jobs are ordered by start, not finish, so a running or recent job can sit in front of expired ones
+            if job.finished_at is None or job.finished_at > cutoff:
+                continue
+            del self.jobs[job_id]
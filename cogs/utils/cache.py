@@ -0,0 +1,248 @@
+import asyncio
+import json
+import os
+import re
+import time
+from collections import OrderedDict
+
+# Matches the video ID of the common YouTube URL forms
+_youtube_id_pattern = re.compile(r"(?:youtube\.com/(?:watch\?(?:.*&)?v=|shorts/|embed/|live/)|youtu\.be/)([\w-]{11})")
+
+# Metadata kept next to each cached file, so a cache hit needs no extraction at all
+_sidecar_keys = ('id', 'extractor', 'title', 'duration', 'webpage_url', 'format_id', 'ext', 'acodec')
+
+
+def normalize_query(query:str):
+    """Lowercases & collapses whitespace, so trivially different queries share an entry."""
+    return re.sub(r"\s+", " ", query).strip().lower()
+
+def cache_key_from_url(url):
+    """Returns the cache key of a URL if it can be worked out without extraction, otherwise None."""
+    match = _youtube_id_pattern.search(url or '')
+    if match:
+        return f"youtube-{match.group(1)}"
+    return None
+
+def _cache_key_from_filename(name):
+    # Files are named '<extractor>-<id>.<format_id>.<ext>'
+    return name.split('.', 1)[0]
+
+
+class AudioCache():
+    """Size-bounded, least-recently-used cache of downloaded audio, shared between every server.
+    Files are keyed by extractor & video ID, so the same track is only downloaded once.
+    Files that are pinned (queued to play, or playing) are never evicted."""
+    # yt-dlp output template that AudioCache expects downloads to use
+    outtmpl = '%(extractor)s-%(id)s.%(format_id)s.%(ext)s'
+
+    def __init__(self, directory:str='downloads', max_bytes:int=2 * 1024**3):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._files = OrderedDict()  # key -> (path, size), least recently used first
+        self._pins = {}  # path -> pin count
+        self._superseded = set()  # pinned paths replaced by a newer download, deleted once unpinned
+        self.rebuild()
+
+    def rebuild(self):
+        """Rebuilds the index from the files already on disk, oldest first."""
+        entries = []
+        with os.scandir(self.directory) as scan:
+            for entry in scan:
+                if not entry.is_file() or entry.name.endswith(('.json', '.part', '.ytdl')):
+                    continue
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name, entry.path, stat.st_size))
+        entries.sort()
+
+        self._files = OrderedDict()
+        self.total_bytes = 0
+        for mtime, name, path, size in entries:
+            self._files[_cache_key_from_filename(name)] = (path, size)
+            self.total_bytes += size
+        self._evict()
+
+    def lookup(self, url):
+        """Returns a pinned info dict for a cached URL, or None if it isn't cached."""
+        key = cache_key_from_url(url)
+        if key is None or key not in self._files:
+            self.misses += 1
+            return None
+        path, size = self._files[key]
+        try:
+            with open(path + '.json', 'r') as file:
+                data = json.load(file)
+        except (OSError, ValueError):
+            # File was removed from under us, or the metadata is missing
+            self._remove(key)
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._touch(key)
+        data['filename'] = path
+        data['url'] = data.get('webpage_url') or url
+        self.pin(path)
+        return data
+
+    def add(self, data, pin:bool=True):
+        """Indexes a freshly downloaded info dict & pins its file, unless 'pin' is False (eg. nothing is going to play it).
+        Evicts old files if the cache is over budget."""
+        path = data['filename']
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        with open(path + '.json', 'w') as file:
+            json.dump({key: data.get(key) for key in _sidecar_keys}, file)
+
+        key = _cache_key_from_filename(os.path.basename(path))
+        if key in self._files:
+            old_path, old_size = self._files.pop(key)
+            self.total_bytes -= old_size
+            if old_path != path:
+                # Same track in another format; keep only the newest download
+                if old_path in self._pins:
+                    self._superseded.add(old_path)
+                else:
+                    self._delete_files(old_path)
+        self._files[key] = (path, size)
+        self._superseded.discard(path)
+        self.total_bytes += size
+        if pin:
+            self.pin(path)
+        self._evict()
+
+    def pin(self, path):
+        self._pins[path] = self._pins.get(path, 0) + 1
+
+    def release(self, data):
+        """Unpins a file once it has finished playing, or will no longer be played."""
+        path = data.get('filename')
+        if path not in self._pins:
+            return
+        self._pins[path] -= 1
+        if self._pins[path] <= 0:
+            del self._pins[path]
+            if path in self._superseded:
+                self._superseded.discard(path)
+                self._delete_files(path)
+        self._evict()
+
+    def stats(self):
+        return {
+            'files': len(self._files),
+            'bytes': self.total_bytes,
+            'max_bytes': self.max_bytes,
+            'pinned': len(self._pins),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+    def _touch(self, key):
+        self._files.move_to_end(key)
+        try:
+            # Persist recency across restarts, since rebuild() orders by mtime
+            os.utime(self._files[key][0])
+        except OSError:
+            pass
+
+    def _evict(self):
+        if self.total_bytes <= self.max_bytes:
+            return
+        for key in list(self._files):
+            if self.total_bytes <= self.max_bytes:
+                break
+            if self._files[key][0] not in self._pins:
+                self._remove(key)
+
+    def _remove(self, key):
+        path, size = self._files.pop(key)
+        self.total_bytes -= size
+        self._delete_files(path)
+
+    def _delete_files(self, path):
+        for file in (path, path + '.json'):
+            try:
+                os.remove(file)
+            except OSError:
+                pass
+
+
+class TTLCache():
+    """Bounded in-memory cache whose entries expire after 'ttl' seconds, evicting the least recently used entry when full.
+    get_or_load() also merges concurrent lookups of the same key into a single load.
+    Cached values are shared between callers, so they must be treated as read-only."""
+    def __init__(self, max_size:int=1024, ttl:float=600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.merged = 0
+        self._entries = OrderedDict()  # key -> (value, expires_at)
+        self._inflight = {}  # key -> [task, waiter count]
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() >= entry[1]:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, value):
+        self._entries[key] = (value, time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    async def get_or_load(self, key, loader, *, store:bool=True):
+        """Returns the cached value for 'key', or awaits 'loader()' and caches its result unless it's None.
+        Callers asking for a key that is already loading wait for that load instead of starting another.
+        If 'store' is False, only the merging of concurrent loads is done."""
+        if store:
+            value = self.get(key)
+            if value is not None:
+                self.hits += 1
+                return value
+
+        entry = self._inflight.get(key)
+        if entry is None:
+            self.misses += 1
+            task = asyncio.ensure_future(loader())
+            entry = self._inflight[key] = [task, 0]
+            task.add_done_callback(lambda done: self._finish_load(key, done, store))
+        else:
+            self.merged += 1
+
+        task = entry[0]
+        entry[1] += 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0 and not task.done():
+                # Every caller gave up, so stop the load
+                task.cancel()
+                if self._inflight.get(key) is entry:
+                    del self._inflight[key]
+
+    def _finish_load(self, key, task, store):
+        if self._inflight.get(key, [None])[0] is task:
+            del self._inflight[key]
+        if store and not task.cancelled() and task.exception() is None and task.result() is not None:
+            self.put(key, task.result())
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'merged': self.merged,
+            'loading': len(self._inflight),
+        }
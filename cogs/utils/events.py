@@ -0,0 +1,78 @@
+import asyncio
+import time
+from collections import deque
+
+
+class Subscription():
+    """A subscriber's buffer of events. Holds at most 'max_pending' events: when a subscriber falls behind, its oldest
+    events are dropped rather than letting the buffer (or the publisher) grow without bound.
+    The next get() then returns a 'lagged' event with the number dropped, so the subscriber knows to refresh its state."""
+    def __init__(self, bus, guild_id, max_pending):
+        self.bus = bus
+        self.guild_id = guild_id
+        self.dropped = 0
+        self._events = deque(maxlen=max_pending)
+        self._ready = asyncio.Event()
+
+    def push(self, event):
+        if len(self._events) == self._events.maxlen:
+            self.dropped += 1
+        self._events.append(event)
+        self._ready.set()
+
+    async def get(self):
+        """Waits for & returns the next event."""
+        while not self._events:
+            self._ready.clear()
+            await self._ready.wait()
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            return {'event': 'lagged', 'guild_id': self.guild_id, 'time': time.time(), 'data': {'dropped': dropped}}
+        return self._events.popleft()
+
+    def close(self):
+        self.bus.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class EventBus():
+    """Fans out events (eg. the music player's) to subscribers, for one server or for all of them.
+    Publishing never blocks or waits on subscribers, so a slow consumer can't hold up playback."""
+    def __init__(self, max_pending:int=256):
+        self.max_pending = max_pending
+        self.published = 0
+        self._subscribers = {}  # guild_id, or None for every server -> set of Subscriptions
+
+    def subscribe(self, guild_id=None):
+        """Returns a Subscription to a server's events, or to every server's if 'guild_id' is None. Close it when done."""
+        subscription = Subscription(self, guild_id, self.max_pending)
+        self._subscribers.setdefault(guild_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        subscribers = self._subscribers.get(subscription.guild_id)
+        if subscribers:
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self._subscribers[subscription.guild_id]
+
+    def has_subscribers(self, guild_id=None):
+        return bool(self._subscribers.get(None) or (guild_id is not None and self._subscribers.get(guild_id)))
+
+    def publish(self, guild_id, event:str, data:dict=None):
+        if not self.has_subscribers(guild_id):
+            return
+        self.published += 1
+        message = {'event': event, 'guild_id': guild_id, 'time': time.time(), 'data': data or {}}
+        for subscription in self._subscribers.get(guild_id, ()):
+            subscription.push(message)
+        for subscription in self._subscribers.get(None, ()):
+            subscription.push(message)
+
+    def stats(self):
+        return {'subscribers': sum(len(subscribers) for subscribers in self._subscribers.values()), 'published': self.published}
@@ -0,0 +1,301 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from yt_dlp import YoutubeDL
+
+from cogs.utils.cache import AudioCache, TTLCache, cache_key_from_url, normalize_query
+
+
+def _filter_livestreams(info_dict, *args, **kwargs):
+    """yt-dlp match_filter that rejects livestreams."""
+    return "Livestream detected" if info_dict.get('is_live') else None
+
+# Declaring ytdl parameters. Each profile gets its own YoutubeDL instance per worker.
+YTDL_PROFILES = {
+    'download': {'format': 'bestaudio/bestaudio/best',  # Prioritize 128kbps audio
+                 'outtmpl': AudioCache.outtmpl,  # Downloaded files will be saved in a 'downloads' folder, named by video ID
+                 'paths': {'home': 'downloads'},  # Overridden per call with the audio cache's directory, see YTDLSource.extract()
+                 'noplaylist': True,
+                 'match_filter': _filter_livestreams,
+    },
+    # Same format selection as 'download', but only resolves the direct media URL for FFmpeg to stream.
+    'stream': {'format': 'bestaudio/bestaudio/best',
+               'noplaylist': True,
+               'match_filter': _filter_livestreams,
+    },
+    'search': {'quiet': True,
+               'default_search': 'ytsearch',
+               'extract_flat': True,
+               'force_generic_extractor': True,
+               'ignoreerrors': True,
+               'skip_download': True,
+               'match_filter': _filter_livestreams,
+    },
+}
+
+# YoutubeDL isn't thread-safe, so every worker thread (or process) keeps its own instances.
+_local = threading.local()
+
+def _get_ytdl(profile):
+    instances = getattr(_local, 'instances', None)
+    if instances is None:
+        instances = _local.instances = {}
+    if profile not in instances:
+        instances[profile] = YoutubeDL(YTDL_PROFILES[profile])
+    return instances[profile]
+
+def _extract(profile, query, download, params=None):
+    """Runs inside the worker pool. Returns a picklable info dict.
+    'params' temporarily override the profile's options, eg. 'playlist_items'.
+    When downloading, the local filename is stored under 'filename'."""
+    ytdl = _get_ytdl(profile)
+    if params:
+        saved_params = {key: ytdl.params.get(key) for key in params}
+        ytdl.params.update(params)
+    try:
+        info = ytdl.extract_info(query, download=download)
+    finally:
+        if params:
+            ytdl.params.update(saved_params)
+    if info is None:
+        return None
+    if download:
+        target = info['entries'][0] if 'entries' in info else info
+        target['filename'] = ytdl.prepare_filename(target)
+    return ytdl.sanitize_info(info)
+
+
+def _lookup_key(profile, query, params=None):
+    """Key that identical lookups share: the video ID for known URLs, otherwise the normalized query."""
+    extra = json.dumps(params, sort_keys=True) if params else ''  # Params can hold dicts, eg. 'paths'
+    if query.startswith('http'):
+        # Playlist URLs also carry a video ID, so only use the ID for single videos
+        return (profile, (cache_key_from_url(query) if 'list=' not in query else None) or query, extra)
+    return (profile, normalize_query(query), extra)
+
+# Priorities of extraction jobs, highest first. Waiting jobs of a higher priority always start first.
+PRIORITY_PLAYBACK = 0  # Someone is waiting on it, eg. a search, or the track that's about to play
+PRIORITY_PREFETCH = 1  # Tracks further down a queue
+
+
+class ExtractionRequest():
+    """The priority of the extractions made for one piece of work, eg. resolving & downloading a track.
+    If one of its jobs has to wait for a worker, 'on_queued(position)' is called with its place in line.
+    A waiting request can be moved up with ExtractionService.promote(), eg. when the track it prefetches is up next."""
+    def __init__(self, priority:int=PRIORITY_PLAYBACK, on_queued=None):
+        self.priority = priority
+        self.on_queued = on_queued
+        self.waiting = None  # (priority, guild_id, waiter future) of the job that's waiting for a worker
+
+def _downloaded_bytes(info):
+    target = info['entries'][0] if 'entries' in info else info
+    try:
+        return os.path.getsize(target['filename'])
+    except (KeyError, OSError):
+        return 0
+
+
+class ExtractionService():
+    """Runs every yt-dlp call off the event loop, on a bounded worker pool.
+    At most 'max_concurrency' extractions run at once. Waiting jobs start by priority (see ExtractionRequest), then
+    round-robin between guilds, so one guild queueing a large batch can't starve the others.
+    Searches & metadata lookups are cached for 'cache_ttl' seconds, and identical lookups in flight are merged.
+    If 'metrics' (a MetricsRegistry) is given, the time each yt-dlp call takes & the bytes downloaded are recorded."""
+    def __init__(self, max_workers:int=4, max_concurrency:int=None, use_processes:bool=False, cache_size:int=1024, cache_ttl:float=600,
+                 metrics=None):
+        self.cache = TTLCache(max_size=cache_size, ttl=cache_ttl)
+        self.max_workers = max_workers
+        self.max_concurrency = max_concurrency or max_workers
+        self.use_processes = use_processes
+        self._executor = None
+        self._pending = [OrderedDict() for _ in range(PRIORITY_PREFETCH + 1)]  # Per priority, guild_id -> deque of waiter futures
+        self._active = 0
+        self._completed = 0
+        self._failed = 0
+        self._wait_times = deque(maxlen=256)
+        self._max_wait = 0.0
+        self._extract_seconds = None
+        if metrics is not None:
+            self._extract_seconds = metrics.histogram('kbot_ytdl_extract_seconds', "How long yt-dlp calls took, by kind.", labels=('kind',))
+            self._download_bytes = metrics.counter('kbot_ytdl_download_bytes_total', "Bytes of audio downloaded by yt-dlp.")
+
+    def _get_executor(self):
+        if self._executor is None:
+            if self.use_processes:
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='ytdl')
+        return self._executor
+
+    def _pump(self):
+        """Grants free slots to waiting jobs of the highest priority, taking one job from each guild in turn."""
+        while self._active < self.max_concurrency:
+            pending = next((pending for pending in self._pending if pending), None)
+            if pending is None:
+                return
+            guild_id, waiters = next(iter(pending.items()))
+            waiter = waiters.popleft()
+            if waiters:
+                pending.move_to_end(guild_id)
+            else:
+                del pending[guild_id]
+            if waiter.done():
+                continue  # Caller gave up while waiting
+            self._active += 1
+            waiter.set_result(None)
+
+    def _release(self):
+        self._active -= 1
+        self._pump()
+
+    def _position(self, priority, guild_id, waiter):
+        """Returns a waiting job's place in line (1 is next), if nothing is queued ahead of it in the meantime."""
+        ahead = sum(len(waiters) for pending in self._pending[:priority] for waiters in pending.values())
+        pending = self._pending[priority]
+        turn = pending[guild_id].index(waiter)
+        # Guilds take turns in the order of 'pending', so the ones before this guild get one more turn before this job
+        before = True
+        for other_guild_id, waiters in pending.items():
+            if other_guild_id == guild_id:
+                before = False
+            ahead += min(len(waiters), turn + 1 if before else turn)
+        return ahead + 1
+
+    async def _acquire(self, guild_id, request=None):
+        waiter = asyncio.get_running_loop().create_future()
+        priority = request.priority if request else PRIORITY_PLAYBACK
+        self._pending[priority].setdefault(guild_id, deque()).append(waiter)
+        queued_at = time.monotonic()
+        self._pump()
+        if not waiter.done() and request:
+            request.waiting = (priority, guild_id, waiter)
+            if request.on_queued:
+                request.on_queued(self._position(priority, guild_id, waiter))
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self._release()
+            else:
+                # Never got a slot, so take it out of line rather than leaving it to inflate the queue & positions
+                self._forget(guild_id, waiter)
+            raise
+        finally:
+            if request and request.waiting and request.waiting[2] is waiter:
+                request.waiting = None
+        waited = time.monotonic() - queued_at
+        self._wait_times.append(waited)
+        self._max_wait = max(self._max_wait, waited)
+
+    def _forget(self, guild_id, waiter):
+        # The waiter may have been moved to another priority by promote()
+        for pending in self._pending:
+            waiters = pending.get(guild_id)
+            if waiters and waiter in waiters:
+                waiters.remove(waiter)
+                if not waiters:
+                    del pending[guild_id]
+                return
+
+    def promote(self, request, priority:int=PRIORITY_PLAYBACK):
+        """Raises a request's priority. Its waiting job, if any, goes ahead of its guild's other jobs of that priority.
+        Returns the job's new place in line, or None if it isn't waiting."""
+        if priority >= request.priority:
+            return None
+        request.priority = priority
+        if request.waiting is None or request.waiting[2].done():
+            return None
+        old_priority, guild_id, waiter = request.waiting
+        waiters = self._pending[old_priority][guild_id]
+        waiters.remove(waiter)
+        if not waiters:
+            del self._pending[old_priority][guild_id]
+        self._pending[priority].setdefault(guild_id, deque()).appendleft(waiter)
+        request.waiting = (priority, guild_id, waiter)
+        self._pump()
+        return None if waiter.done() else self._position(priority, guild_id, waiter)
+
+    async def extract(self, query, *, profile:str='search', download:bool=False, guild_id=None, params:dict=None, kind:str=None,
+                      request:ExtractionRequest=None, on_abandoned=None):
+        """Runs 'extract_info' for the given query using one of YTDL_PROFILES.
+        'kind' labels the call in the metrics, and defaults to 'download', or the profile's name.
+        'request' sets the job's priority, and is told if the job has to wait. Jobs without one have PRIORITY_PLAYBACK.
+        The returned info dict may be shared with other callers, so copy it before modifying it.
+        Downloads are never cached, as the audio cache keeps track of those, but concurrent downloads of the same URL are merged.
+        yt-dlp can't be interrupted, so if every caller gives up once the job has started, it runs to the end anyway.
+        Its info dict is then passed to 'on_abandoned(info)', eg. so the audio cache can account for the downloaded file."""
+        return await self.cache.get_or_load(_lookup_key(profile, query, params),
+                                            lambda: self._run(query, profile, download, guild_id, params, kind, request, on_abandoned),
+                                            store=not download)
+
+    async def _run(self, query, profile, download, guild_id, params=None, kind=None, request=None, on_abandoned=None):
+        await self._acquire(guild_id, request)
+        kind = kind or ('download' if download else profile)
+        started = time.perf_counter()
+        try:
+            job = self._get_executor().submit(_extract, profile, query, download, params)
+            result = await asyncio.shield(asyncio.wrap_future(job))
+        except asyncio.CancelledError:
+            if job.cancel():
+                self._release()
+            else:
+                # The job keeps its worker until it finishes, so it still counts towards 'max_concurrency'
+                loop = asyncio.get_running_loop()
+                job.add_done_callback(lambda job: loop.call_soon_threadsafe(self._finish_abandoned, job, kind, started, on_abandoned))
+            raise
+        except Exception:
+            self._failed += 1
+            self._release()
+            raise
+        self._finish(result, kind, started)
+        return result
+
+    def _finish(self, result, kind, started):
+        if self._extract_seconds is not None:
+            self._extract_seconds.observe(time.perf_counter() - started, kind)
+            if kind == 'download' and result:
+                self._download_bytes.inc(amount=_downloaded_bytes(result))
+        self._completed += 1
+        self._release()
+
+    def _finish_abandoned(self, job, kind, started, on_abandoned):
+        """Called on the event loop once a job that every caller gave up on has finished."""
+        if job.cancelled() or job.exception() is not None:
+            self._failed += 1
+            self._release()
+            return
+        result = job.result()
+        self._finish(result, kind, started)
+        if result and on_abandoned:
+            try:
+                on_abandoned(result)
+            except Exception as e:
+                print(f"Couldn't handle an abandoned extraction: {e}")
+
+    def stats(self):
+        """Returns a snapshot of queue depth & wait times."""
+        waits = list(self._wait_times)
+        return {
+            'workers': self.max_workers,
+            'max_concurrency': self.max_concurrency,
+            'mode': 'process' if self.use_processes else 'thread',
+            'active': self._active,
+            'queued': sum(len(waiters) for pending in self._pending for waiters in pending.values()),
+            'queued_prefetches': sum(len(waiters) for waiters in self._pending[PRIORITY_PREFETCH].values()),
+            'queued_guilds': len(set().union(*self._pending)),
+            'completed': self._completed,
+            'failed': self._failed,
+            'avg_wait': sum(waits) / len(waits) if waits else 0.0,
+            'max_wait': self._max_wait,
+            'cache': self.cache.stats(),
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
@@ -0,0 +1,107 @@
+import asyncio
+import json
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class GuildStore():
+    """Persists a JSON-serializable state per server (eg. settings, or queues) to a SQLite table.
+    Changes only mark a server as dirty. A background task writes every dirty server in a single transaction
+    every 'interval' seconds, so a burst of changes (eg. queueing a playlist) costs one write."""
+    def __init__(self, path:str, table:str, interval:float=1.0):
+        self.path = path
+        self.table = table
+        self.interval = interval
+        self.writes = 0
+        self._dirty = {}  # guild_id -> callable returning the state to save, or None to delete it
+        self._task = None
+        self._closed = False
+        # A single writer thread owns the connection, so writes never block the event loop or race each other
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'{table}_store')
+        self._connection = None
+        self._writer.submit(self._open).result()
+
+    def _open(self):
+        self._connection = sqlite3.connect(self.path)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute(f'CREATE TABLE IF NOT EXISTS {self.table} (guild_id INTEGER PRIMARY KEY, state TEXT NOT NULL, saved_at REAL NOT NULL)')
+        self._connection.commit()
+
+    def load(self):
+        """Returns a dict of guild_id -> saved state, for every server with a saved state."""
+        def read():
+            return self._connection.execute(f'SELECT guild_id, state FROM {self.table}').fetchall()
+        return {guild_id: json.loads(state) for guild_id, state in self._writer.submit(read).result()}
+
+    def save_now(self, states:dict):
+        """Writes a dict of guild_id -> state immediately, in one transaction. Used for bulk imports."""
+        rows = [(guild_id, _dump(state)) for guild_id, state in states.items()]
+        self._writer.submit(self._write, rows, time.time()).result()
+
+    def mark_dirty(self, guild_id, snapshot):
+        """Schedules a server's state to be saved on the next flush. 'snapshot' is called at flush time.
+        Once the store is closed there are no more flushes, so the state is written straight away instead."""
+        if self._closed:
+            connection = sqlite3.connect(self.path)
+            try:
+                self._write([(guild_id, _dump(snapshot()))], time.time(), connection)
+            finally:
+                connection.close()
+            return
+        self._dirty[guild_id] = snapshot
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Failed to save {self.table}: {e}")
+
+    async def flush(self):
+        """Writes every dirty server's state in one transaction.
+        If that fails, the servers stay dirty (unless they were marked again meanwhile) for the next flush to retry."""
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, {}
+        saved_at = time.time()
+        try:
+            rows = [(guild_id, _dump(snapshot())) for guild_id, snapshot in dirty.items()]
+            await asyncio.get_running_loop().run_in_executor(self._writer, self._write, rows, saved_at)
+        except BaseException:
+            for guild_id, snapshot in dirty.items():
+                self._dirty.setdefault(guild_id, snapshot)
+            raise
+        self.writes += 1
+
+    def _write(self, rows, saved_at, connection=None):
+        connection = connection or self._connection
+        with connection:
+            connection.executemany(f'INSERT OR REPLACE INTO {self.table} VALUES (?, ?, ?)',
+                                   [(guild_id, state, saved_at) for guild_id, state in rows if state])
+            connection.executemany(f'DELETE FROM {self.table} WHERE guild_id = ?',
+                                   [(guild_id,) for guild_id, state in rows if not state])
+
+    async def close(self):
+        """Stops the background task, writes any pending changes & closes the database."""
+        if self._closed:
+            return
+        self._closed = True
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        try:
+            await self.flush()
+        finally:
+            self._writer.submit(self._connection.close)
+            self._writer.shutdown(wait=True)
+
+def _dump(state):
+    # Empty states are deleted rather than saved
+    return json.dumps(state, separators=(',', ':')) if state else None
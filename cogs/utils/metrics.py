@@ -0,0 +1,153 @@
+import time
+from bisect import bisect_left
+
+# Seconds. Suits most latencies in the bot, from a command to a yt-dlp download
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _format_labels(names, values, extra=''):
+    pairs = [f'{name}="{str(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _format_value(value):
+    return repr(float(value)) if value != float('inf') else '+Inf'
+
+
+class _Metric():
+    type = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._values = {}  # label values -> value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        lines.extend(self._samples())
+        return lines
+
+    def _samples(self):
+        return [f'{self.name}{_format_labels(self.label_names, labels)} {_format_value(value)}' for labels, value in self._values.items()]
+
+
+class Counter(_Metric):
+    """A count that only goes up, eg. requests served. Label values are passed positionally: counter.inc('search')"""
+    type = 'counter'
+
+    def inc(self, *labels, amount:float=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def set(self, value, *labels):
+        """For collectors that mirror a count kept elsewhere, eg. a cache's hits."""
+        self._values[labels] = value
+
+
+class Gauge(_Metric):
+    """A value that goes up & down, eg. voice connections."""
+    type = 'gauge'
+
+    def set(self, value, *labels):
+        self._values[labels] = value
+
+    def inc(self, *labels, amount:float=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount:float=1):
+        self.inc(*labels, amount=-amount)
+
+    def clear(self):
+        """Removes every label set, eg. before a collector sets the current ones."""
+        self._values.clear()
+
+
+class Histogram(_Metric):
+    """Counts observations (eg. latencies) into buckets, for percentiles. Observing is a bisect & two additions."""
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        counts = self._values.get(labels)
+        if counts is None:
+            # One count per bucket, then +Inf, then the sum
+            counts = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def time(self, *labels):
+        """Context manager that observes how long its block took."""
+        return _Timer(self, labels)
+
+    def _samples(self):
+        lines = []
+        for labels, counts in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                bound_label = 'le="' + _format_value(bound) + '"'
+                lines.append(f'{self.name}_bucket{_format_labels(self.label_names, labels, bound_label)} {cumulative}')
+            label_string = _format_labels(self.label_names, labels)
+            lines.append(f'{self.name}_sum{label_string} {_format_value(counts[-1])}')
+            lines.append(f'{self.name}_count{label_string} {cumulative}')
+        return lines
+
+
+class _Timer():
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+
+
+class MetricsRegistry():
+    """bot.metrics. Holds the bot's metrics, and renders them in Prometheus' text format for the web API's /metrics.
+    Metrics are created on first use & returned as-is afterwards, so cogs can be reloaded.
+    Values that are already tracked elsewhere (eg. cache stats) are read at scrape time by collectors instead."""
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = {}
+
+    def _get(self, cls, name, documentation, labels, **kwargs):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = cls(name, documentation, labels, **kwargs)
+        elif not isinstance(metric, cls):
+            raise Exception(f"Metric {name} is already registered as a {metric.type}")
+        return metric
+
+    def counter(self, name, documentation, labels=()):
+        return self._get(Counter, name, documentation, labels)
+
+    def gauge(self, name, documentation, labels=()):
+        return self._get(Gauge, name, documentation, labels)
+
+    def histogram(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, documentation, labels, buckets=buckets)
+
+    def register_collector(self, name, callback):
+        """Registers 'callback()', called on every scrape to update metrics. Registering a name again replaces its callback."""
+        self._collectors[name] = callback
+
+    def unregister_collector(self, name):
+        self._collectors.pop(name, None)
+
+    def render(self):
+        for name, callback in list(self._collectors.items()):
+            try:
+                callback()
+            except Exception as e:
+                print(f"Metrics collector {name} failed: {e}")
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,46 @@
+class PrefixCache():
+    """Flat map of guild ID -> command prefixes, so resolving a message's prefixes is a single dict lookup.
+    Entries are filled from every server's saved settings at startup, and kept up to date by Server.set_prefix() in kbot.py,
+    rather than read from settings per message.
+    Servers can have several prefixes, and can also be addressed by mentioning the bot."""
+    def __init__(self, default_prefix:str):
+        self.default = [default_prefix]
+        self._mentions = []
+        self._settings = {}  # guild ID -> (prefixes, mention)
+        self._prefixes = {}  # guild ID -> prefix list, ready to hand to discord.py
+
+    def get(self, guild_id):
+        """Returns a guild's prefix list, or None if the guild has no saved settings."""
+        return self._prefixes.get(guild_id)
+
+    def get_prefix(self, bot, message):
+        """The bot's 'command_prefix'. Returns a server's prefixes, or the default prefix outside of servers & for servers
+        without saved settings. Runs for every message the bot sees, so it's a dict lookup that never loads the server."""
+        if message.guild is None:
+            return self.default
+        prefixes = self._prefixes.get(message.guild.id)
+        return prefixes if prefixes is not None else self.default
+
+    def set(self, guild_id, prefixes, mention:bool=False):
+        """Sets a guild's prefixes. 'prefixes' can be a single prefix or a list of them."""
+        if isinstance(prefixes, str):
+            prefixes = [prefixes]
+        self._settings[guild_id] = (tuple(prefixes), mention)
+        self._prefixes[guild_id] = self._build(prefixes, mention)
+
+    def discard(self, guild_id):
+        self._settings.pop(guild_id, None)
+        self._prefixes.pop(guild_id, None)
+
+    def set_user(self, user_id):
+        """Sets the bot's user ID, which mention prefixes are built from. The bot's user is only known once it has logged in."""
+        self._mentions = [f"<@{user_id}> ", f"<@!{user_id}> "]
+        for guild_id, (prefixes, mention) in self._settings.items():
+            self._prefixes[guild_id] = self._build(prefixes, mention)
+
+    def _build(self, prefixes, mention):
+        # discord.py uses the first prefix that matches, so longer prefixes go first. Eg. '!!' before '!'
+        return sorted(set(prefixes), key=len, reverse=True) + (self._mentions if mention else [])
+
+    def __len__(self):
+        return len(self._prefixes)
@@ -0,0 +1,72 @@
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from cogs.utils.cache import normalize_query
+
+
+class ResolutionCache():
+    """Persistent mapping of search queries (eg. Spotify's "artist, title") to the YouTube URL they resolved to.
+    Entries are kept in memory for lookups, and written to SQLite on a background thread so they survive restarts.
+    Entries expire after 'ttl' seconds, and can be invalidated when the video stops being playable."""
+    def __init__(self, path:str, ttl:float=30 * 24 * 3600):
+        self.path = path
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}  # normalized query -> (url, resolved_at)
+        # A single writer thread owns the connection, so writes never block the event loop or race each other
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='resolutions')
+        self._connection = None
+        self._writer.submit(self._open).result()
+
+    def _open(self):
+        self._connection = sqlite3.connect(self.path)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS resolutions (query TEXT PRIMARY KEY, url TEXT NOT NULL, resolved_at REAL NOT NULL)')
+        self._connection.execute('DELETE FROM resolutions WHERE resolved_at < ?', (time.time() - self.ttl,))
+        self._connection.commit()
+        for query, url, resolved_at in self._connection.execute('SELECT query, url, resolved_at FROM resolutions'):
+            self._entries[query] = (url, resolved_at)
+
+    def _lookup(self, query):
+        entry = self._entries.get(normalize_query(query))
+        if entry and time.time() - entry[1] < self.ttl:
+            return entry[0]
+        return None
+
+    def __contains__(self, query):
+        return self._lookup(query) is not None
+
+    def get(self, query):
+        """Returns the cached URL for a query, or None."""
+        url = self._lookup(query)
+        if url:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return url
+
+    def put(self, query, url):
+        key = normalize_query(query)
+        resolved_at = time.time()
+        self._entries[key] = (url, resolved_at)
+        self._writer.submit(self._write, 'INSERT OR REPLACE INTO resolutions VALUES (?, ?, ?)', (key, url, resolved_at))
+
+    def invalidate(self, query):
+        """Forgets a query's URL, eg. because the video was taken down."""
+        key = normalize_query(query)
+        if self._entries.pop(key, None):
+            self._writer.submit(self._write, 'DELETE FROM resolutions WHERE query = ?', (key,))
+
+    def _write(self, statement, parameters):
+        self._connection.execute(statement, parameters)
+        self._connection.commit()
+
+    def stats(self):
+        return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+    def close(self):
+        """Finishes pending writes & closes the database."""
+        self._writer.submit(self._connection.close)
+        self._writer.shutdown(wait=True)
@@ -0,0 +1,60 @@
+import asyncio
+from collections import OrderedDict
+
+
+class PlaybackSlots():
+    """bot.playback_slots. Caps how many servers play at once, and so how many FFmpeg processes run.
+    A server takes a slot when its first track is ready, and keeps it until its queue runs out or playback is stopped.
+    When every slot is taken, servers wait in line, first come first served. A 'limit' of None means no limit."""
+    def __init__(self, limit:int=None):
+        self.limit = limit
+        self._holders = set()
+        self._waiting = OrderedDict()  # guild_id -> waiter future, first in line first
+
+    def _has_room(self):
+        return self.limit is None or len(self._holders) < self.limit
+
+    async def acquire(self, guild_id, on_queued=None):
+        """Waits for a slot, unless the server already has one. If it has to wait, 'on_queued(position)' is called first.
+        Returns False if the server gave up its place in line (see release()) instead of getting a slot."""
+        if guild_id in self._holders:
+            return True
+        if self._has_room() and not self._waiting:
+            self._holders.add(guild_id)
+            return True
+
+        waiter = self._waiting.get(guild_id)
+        if waiter is None:
+            waiter = self._waiting[guild_id] = asyncio.get_running_loop().create_future()
+            if on_queued:
+                on_queued(len(self._waiting))
+        try:
+            return await asyncio.shield(waiter)
+        except asyncio.CancelledError:
+            if self._waiting.get(guild_id) is waiter:
+                del self._waiting[guild_id]
+            elif waiter.done() and waiter.result():
+                # Got the slot just as the caller gave up
+                self.release(guild_id)
+            raise
+
+    def release(self, guild_id):
+        """Frees a server's slot, or takes it out of line, and lets the next servers in line play."""
+        self._holders.discard(guild_id)
+        waiter = self._waiting.pop(guild_id, None)
+        if waiter and not waiter.done():
+            waiter.set_result(False)
+        while self._waiting and self._has_room():
+            next_guild_id, waiter = self._waiting.popitem(last=False)
+            self._holders.add(next_guild_id)
+            waiter.set_result(True)
+
+    def position(self, guild_id):
+        """Returns a server's place in line (1 is next), or None if it isn't waiting."""
+        for position, waiting_guild_id in enumerate(self._waiting, 1):
+            if waiting_guild_id == guild_id:
+                return position
+        return None
+
+    def stats(self):
+        return {'limit': self.limit, 'playing': len(self._holders), 'waiting': len(self._waiting)}
@@ -0,0 +1,114 @@
+import asyncio
+import time
+
+import aiohttp
+
+SPOTIFY_AUTH_URL = 'https://accounts.spotify.com/api/token'
+SPOTIFY_API_URL = 'https://api.spotify.com/v1'
+
+
+class SpotifyTokenManager():
+    """Holds a Client Credentials access token for as long as Spotify says it's valid.
+    The token is refreshed 'refresh_margin' seconds before it expires. Concurrent callers share a single refresh."""
+    def __init__(self, client_id, client_secret, refresh_margin:int=60):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.refresh_margin = refresh_margin
+        self._token = None
+        self._expires_at = 0.0
+        self._lock = asyncio.Lock()
+
+    def _is_valid(self):
+        return self._token is not None and time.monotonic() < self._expires_at - self.refresh_margin
+
+    async def get_token(self, session:aiohttp.ClientSession):
+        """Returns a valid access token, fetching a new one first if needed."""
+        if self._is_valid():
+            return self._token
+        async with self._lock:
+            # Another caller may have refreshed the token while we were waiting for the lock
+            if not self._is_valid():
+                await self._refresh(session)
+            return self._token
+
+    def invalidate(self):
+        """Forces the next get_token() to fetch a new token, eg. after a 401 from the API."""
+        self._token = None
+
+    async def _refresh(self, session):
+        # Request based on Client Credentials Flow from Spotify's documentation
+        async with session.post(SPOTIFY_AUTH_URL, data={
+            'grant_type': 'client_credentials',
+            'client_id': self.client_id,
+            'client_secret': self.client_secret,
+        }) as response:
+            response_data = await response.json()
+        if 'access_token' not in response_data:
+            raise Exception(f"Couldn't authenticate with Spotify: {response_data.get('error_description', response.status)}")
+        self._token = response_data['access_token']
+        self._expires_at = time.monotonic() + response_data.get('expires_in', 3600)
+
+
+class SpotifyClient():
+    """Async client for the parts of Spotify's Web API that KBot uses.
+    Keeps connections alive between requests, caps concurrent requests, honors 429 'Retry-After' and retries server errors with backoff."""
+    def __init__(self, client_id, client_secret, max_concurrency:int=8, max_retries:int=4):
+        self.tokens = SpotifyTokenManager(client_id, client_secret)
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self._session = None
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_concurrency, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=30))
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def get(self, path:str, params:dict=None):
+        """GETs an API path (eg. '/tracks/<id>') and returns the decoded JSON."""
+        session = self._get_session()
+        for attempt in range(self.max_retries + 1):
+            delay = 0.5 * 2 ** attempt
+            try:
+                token = await self.tokens.get_token(session)
+                async with self._semaphore:
+                    async with session.get(SPOTIFY_API_URL + path, params=params, headers={"Authorization": f"Bearer {token}"}) as response:
+                        if response.status == 429:
+                            delay = float(response.headers.get('Retry-After', delay))
+                        elif response.status == 401:
+                            self.tokens.invalidate()
+                            delay = 0
+                        elif response.status < 500:
+                            data = await response.json()
+                            if response.status >= 400:
+                                raise Exception(f"Spotify error {response.status}: {data.get('error', {}).get('message')}")
+                            return data
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt == self.max_retries:
+                    raise Exception(f"Couldn't reach Spotify: {e}")
+            # Sleep outside of the semaphore, so waiting doesn't hold up other requests
+            await asyncio.sleep(delay)
+        raise Exception("Spotify is unavailable right now, try again later.")
+
+    async def get_track(self, track_id):
+        return await self.get(f"/tracks/{track_id}")
+
+    async def get_playlist_page(self, playlist_id, offset:int=0, limit:int=100):
+        """Returns a tuple of (track objects, total) for a single page of a playlist."""
+        page = await self.get(f"/playlists/{playlist_id}/tracks", {'limit': limit, 'offset': offset})
+        return _playlist_item_tracks(page['items']), page['total']
+
+    async def get_album_page(self, album_id, offset:int=0, limit:int=50):
+        """Returns a tuple of (track objects, total) for a single page of an album."""
+        page = await self.get(f"/albums/{album_id}/tracks", {'limit': limit, 'offset': offset})
+        return page['items'], page['total']
+
+def _playlist_item_tracks(items):
+    # Playlist items wrap the track, which is missing for removed tracks, and has no artists for local files
+    return [item['track'] for item in items if item.get('track') and item['track'].get('artists')]
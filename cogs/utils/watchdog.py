@@ -0,0 +1,100 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+import weakref
+from collections import deque
+
+logger = logging.getLogger('kbot.watchdog')
+
+# Frames from files under here are the bot's own code, for finding the call site that blocked the loop
+_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class LoopWatchdog():
+    """Detects when something blocks the event loop for longer than 'threshold' seconds, and reports what it was.
+    The loop updates a heartbeat every 'interval' seconds. A side thread checks it, and while the loop is stalled,
+    samples the loop thread's stack with sys._current_frames(). Once the loop recovers, the most sampled stack is
+    logged with the command & server that the blocked task was handling (see track()), and kept in 'reports'.
+    Costs one timer callback per interval while the loop is healthy."""
+    def __init__(self, loop, threshold:float=0.25, interval:float=None, history:int=50, metrics=None):
+        self.loop = loop
+        self.threshold = threshold
+        self.interval = interval or threshold / 4
+        self.reports = deque(maxlen=history)
+        self.stalls = 0
+        self._contexts = weakref.WeakKeyDictionary()  # Task -> {'command', 'guild_id'}
+        self._last_beat = time.monotonic()
+        self._beat_handle = None
+        self._loop_thread_id = None
+        self._thread = None
+        self._stopping = threading.Event()
+        self._stall_seconds = None
+        if metrics is not None:
+            self._stall_seconds = metrics.histogram('kbot_event_loop_stall_seconds', "How long the event loop was blocked, per stall past the watchdog's threshold.",
+                                                    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+
+    def start(self):
+        """Starts watching. Must be called from the event loop's thread."""
+        self._loop_thread_id = threading.get_ident()
+        self._beat()
+        self._thread = threading.Thread(target=self._watch, name='loop-watchdog', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._beat_handle:
+            self._beat_handle.cancel()
+
+    def track(self, command:str=None, guild_id=None):
+        """Labels the running task with what it's doing, for the reports of stalls it causes."""
+        task = asyncio.current_task()
+        if task is not None:
+            self._contexts[task] = {'command': command, 'guild_id': guild_id}
+
+    def _beat(self):
+        self._last_beat = time.monotonic()
+        self._beat_handle = self.loop.call_later(self.interval, self._beat)
+
+    def _watch(self):
+        stalled_since = None
+        while not self._stopping.wait(self.interval):
+            last_beat = self._last_beat
+            if time.monotonic() - last_beat - self.interval > self.threshold:
+                if stalled_since is None:
+                    stalled_since = last_beat
+                    samples = {}
+                    task = asyncio.current_task(self.loop)
+                frame = sys._current_frames().get(self._loop_thread_id)
+                if frame is not None:
+                    stack = traceback.extract_stack(frame)
+                    del frame
+                    key = tuple((entry.filename, entry.lineno) for entry in stack)
+                    samples[key] = (samples[key][0] + 1, stack) if key in samples else (1, stack)
+            elif stalled_since is not None:
+                self._report(self._last_beat - stalled_since - self.interval, samples, task)
+                stalled_since = task = None
+
+    def _report(self, duration, samples, task):
+        count, stack = max(samples.values(), key=lambda sample: sample[0]) if samples else (0, [])
+        call_site = next((entry for entry in reversed(stack) if entry.filename.startswith(_ROOT)), stack[-1] if stack else None)
+        context = self._contexts.get(task, {}) if task is not None else {}
+        report = {
+            'time': time.time(),
+            'duration': round(duration, 3),
+            'call_site': f"{os.path.relpath(call_site.filename, _ROOT)}:{call_site.lineno} in {call_site.name}" if call_site else None,
+            'command': context.get('command'),
+            'guild_id': context.get('guild_id'),
+            'task': task.get_name() if task is not None else None,
+            'samples': sum(sample[0] for sample in samples.values()),
+            'stack': ''.join(traceback.format_list(stack)),
+        }
+        self.stalls += 1
+        self.reports.append(report)
+        logger.warning(f"Event loop blocked for {duration:.2f}s at {report['call_site']} (command: {report['command']}, guild: {report['guild_id']}, "
+                       f"task: {report['task']}). Stack, seen in {count} of {report['samples']} samples:\n{report['stack']}")
+        if self._stall_seconds is not None:
+            self.loop.call_soon_threadsafe(self._stall_seconds.observe, duration)
@@ -1,21 +1,51 @@
+import asyncio
 import os
 import logging
 import json
+import signal
 import sys
+import time
 import traceback
+import yarl
 from dotenv import load_dotenv
 
 import discord
 from discord.ext import commands
 
+from cogs.utils.guild_store import GuildStore
+from cogs.utils.metrics import MetricsRegistry
+from cogs.utils.prefixes import PrefixCache
+from cogs.utils.watchdog import LoopWatchdog
+
+# How long each phase of startup took, in seconds. Reported once the bot is ready, and kept as bot.startup_timings
+startup_timings = {}
+_phase_started = time.perf_counter()
+
+def end_phase(name):
+    """Records the time since the previous phase ended as the duration of phase 'name'."""
+    global _phase_started
+    now = time.perf_counter()
+    startup_timings[name] = now - _phase_started
+    _phase_started = now
 
 # Initializes some global variables for the bot. Tokens, api keys, etc.
 def load_config():
     config = {
         'discord_token': os.environ.get('DISCORD_TOKEN'),
         'default_prefix': os.environ.get('DEFAULT_PREFIX'),
-        
+        'server_idle_ttl': float(os.environ.get('SERVER_IDLE_TTL', 0)) or None,
+        # Sharding. SHARDED=1 lets discord.py pick the shard count, SHARD_COUNT & SHARD_IDS (eg. '0,1,2') are set by launcher.py
+        'shard_count': int(os.environ['SHARD_COUNT']) if os.environ.get('SHARD_COUNT') else None,
+        'shard_ids': [int(shard_id) for shard_id in os.environ['SHARD_IDS'].split(',')] if os.environ.get('SHARD_IDS') else None,
+        # Overrides for Discord's endpoints, eg. to run against benchmarks/stub_gateway.py
+        'discord_api_url': os.environ.get('DISCORD_API_URL'),
+        'discord_gateway_url': os.environ.get('DISCORD_GATEWAY_URL'),
+        # How often the event loop's responsiveness is sampled for the metrics, in seconds
+        'loop_lag_interval': float(os.environ.get('LOOP_LAG_INTERVAL', 0.5)),
+        # Opt-in. Logs the stack of anything that blocks the event loop for longer than this many seconds
+        'loop_watchdog_threshold': float(os.environ.get('LOOP_WATCHDOG_THRESHOLD', 0)) or None,
     }
+    config['sharded'] = os.environ.get('SHARDED', '').lower() in ('1', 'true', 'yes') or config['shard_count'] is not None
 
     if not config['default_prefix']:
         config['default_prefix'] = "!"
@@ -49,10 +79,48 @@ if not os.path.exists('downloads'):
     os.makedirs('downloads')
 if not os.path.exists('servers'):
         os.makedirs('servers')
+end_phase('config')
+
+# Every server's settings are kept in one SQLite database. Changes are written in batches, off the event loop.
+settings_store = GuildStore('servers/settings.db', 'settings')
+
+def migrate_json_settings():
+    """One-time import of the old per-server 'servers/<id>.json' settings files into settings_store.
+    Imported files are renamed to '<id>.json.migrated'."""
+    states = {}
+    for filename in os.listdir('servers'):
+        if filename.endswith('.json') and filename[:-5].isdigit():
+            try:
+                with open(f'servers/{filename}', 'r') as file:
+                    states[int(filename[:-5])] = json.load(file)
+            except FileNotFoundError:
+                pass  # Another worker process (see launcher.py) migrated it first
+    if not states:
+        return
+    settings_store.save_now(states)
+    for guild_id in states:
+        try:
+            os.rename(f'servers/{guild_id}.json', f'servers/{guild_id}.json.migrated')
+        except FileNotFoundError:
+            pass
+    print(f"Migrated settings of {len(states)} servers to servers/settings.db")
+
+migrate_json_settings()
+
+# Every server's saved settings, read once here so that loading a server never waits on the database. Kept up to date by Server
+saved_settings = settings_store.load()
+
+# Every server's command prefixes, for the bot's command_prefix. Servers without saved settings use the default prefix
+prefix_cache = PrefixCache(config["default_prefix"])
+for guild_id, settings in saved_settings.items():
+    prefix_cache.set(guild_id, settings.get('prefix') or config["default_prefix"], settings.get('mention_prefix', False))
+end_phase('settings')
 
 
 class Server():
-    def __init__(self, guild_id):
+    __slots__ = ('id', 'settings', 'modules', 'registry', 'last_active')
+
+    def __init__(self, guild_id, registry=None):
         self.id = guild_id
         # The 'settings' dict can also be used to hold data from other modules, and is directly accessed.
         self.settings = {
@@ -61,75 +129,217 @@ class Server():
             'playlists': {}
         }
         # Other modules are intended to put their settings here. Eg. cogs.music
+        # Their runtime state goes in 'modules', and is created on first access. See ServerRegistry.register_module()
+        self.modules = {}
+        self.registry = registry
+        self.last_active = time.monotonic()
 
-    def set_prefix(self, prefix):
-        self.settings['prefix'] = prefix
+    def __getattr__(self, name):
+        # Only called for attributes that don't exist, eg. 'server.music'
+        if name in self.modules:
+            return self.modules[name]
+        factory = self.registry.module_factories.get(name) if self.registry else None
+        if factory is None:
+            raise AttributeError(f"'Server' object has no attribute '{name}'")
+        self.modules[name] = factory(self)
+        return self.modules[name]
+
+    def is_idle(self):
+        """Returns True if none of the server's modules are doing anything, so it can be dropped from memory."""
+        return all(module.is_idle() for module in self.modules.values() if hasattr(module, 'is_idle'))
+
+    def set_prefix(self, *prefixes):
+        """Sets one or more command prefixes for this server."""
+        self.settings['prefix'] = prefixes[0] if len(prefixes) == 1 else list(prefixes)
         self.save_settings()
-        return f"Command prefix set to `{prefix}` for this server!"
+        self.cache_prefixes()
+        return f"Command prefix set to {', '.join(f'`{prefix}`' for prefix in prefixes)} for this server!"
+
+    def set_mention_prefix(self, enabled:bool):
+        """Sets whether the bot's commands can also be used by mentioning it, eg. '@KBot play ...'"""
+        self.settings['mention_prefix'] = enabled
+        self.save_settings()
+        self.cache_prefixes()
+        return f"Mention prefix {'enabled' if enabled else 'disabled'} for this server!"
+
+    def cache_prefixes(self):
+        prefix_cache.set(self.id, self.settings.get('prefix') or config["default_prefix"], self.settings.get('mention_prefix', False))
 
     def load_settings(self):
-        filename = str(self.id) + '.json'
-        if filename in os.listdir('servers'):
-            file = open(f'servers/{filename}', 'r')
-            self.settings = json.load(file)
+        """Loads this server's saved settings, if any."""
+        settings = saved_settings.get(self.id)
+        if settings:
+            self.settings = settings
+        self.cache_prefixes()
 
     def save_settings(self):
-        filename = str(self.id) + '.json'
-        with open(f'servers/{filename}', 'w') as file:
-            json.dump(self.settings, file)
-
-def get_prefix(bot, message):
-    """Returns a server's set 'prefix', or the bot's default_prefix if the server is not initialized."""
-    if message.guild:
-        if message.guild.id in bot.server_data:
-            return bot.server_data[message.guild.id].settings.get('prefix')
-    return config["default_prefix"]
-
-def initialize_servers():
-    """Initializes the Discord bot.server_data that the bot has access to, then recursively attempts to load each server's settings from './bot.server_data/'."""
-    for guild in bot.guilds:
-        print(f"Initializing {guild.name} with id {guild.id}")
-        bot.server_data[guild.id] = Server(guild.id)
-        bot.server_data[guild.id].load_settings()
-
-bot = commands.Bot(command_prefix=get_prefix, intents=intents)
-bot.server_data = {}
+        """Schedules the settings to be saved with the next batch."""
+        # Also keeps them for when the server is loaded again, if it's dropped for being idle
+        saved_settings[self.id] = self.settings
+        settings_store.mark_dirty(self.id, lambda: self.settings)
+
+class ServerRegistry(dict):
+    """bot.server_data. Maps guild IDs to Server objects, which are created & loaded the first time they're accessed,
+    so memory use follows the servers that are actually active rather than every server the bot is in.
+    If 'idle_ttl' is set, servers that haven't been accessed for that many seconds (and are idle) are dropped."""
+    def __init__(self, idle_ttl:float=None):
+        super().__init__()
+        self.idle_ttl = idle_ttl
+        self.module_factories = {}
+        self._sweep_task = None
+
+    def __missing__(self, guild_id):
+        server = Server(guild_id, self)
+        server.load_settings()
+        self[guild_id] = server
+        return server
+
+    def __getitem__(self, guild_id):
+        server = super().__getitem__(guild_id)
+        server.last_active = time.monotonic()
+        return server
+
+    def register_module(self, name, factory):
+        """Registers 'factory(server)', which creates a module's state the first time 'server.<name>' is accessed."""
+        self.module_factories[name] = factory
+
+    def unregister_module(self, name):
+        """Removes a module's factory, and its state from every server. Eg. when its cog is unloaded."""
+        self.module_factories.pop(name, None)
+        for server in self.values():
+            server.modules.pop(name, None)
+
+    def start_sweeping(self, interval:float=300):
+        if self.idle_ttl and self._sweep_task is None:
+            self._sweep_task = bot.loop.create_task(self._sweep(interval))
+
+    async def _sweep(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            cutoff = time.monotonic() - self.idle_ttl
+            for guild_id in [guild_id for guild_id, server in self.items() if server.last_active < cutoff and server.is_idle()]:
+                del self[guild_id]
+
+async def monitor_loop_lag(interval:float):
+    """Measures how late the event loop wakes up from a sleep. Anything blocking the loop (eg. a slow callback) shows up as lag."""
+    histogram = bot.metrics.histogram('kbot_event_loop_lag_seconds', "How late the event loop ran a timer.",
+                                      buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+    gauge = bot.metrics.gauge('kbot_event_loop_lag_last_seconds', "The event loop's lag at the last sample.")
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lag = max(0.0, time.perf_counter() - start - interval)
+        histogram.observe(lag)
+        gauge.set(lag)
+
+def _ffmpeg_process_count():
+    count = 0
+    for voice_client in bot.voice_clients:
+        source = getattr(voice_client, 'source', None)
+        # Volume controls wrap the FFmpeg source
+        source = getattr(source, 'original', source)
+        process = getattr(source, '_process', None)
+        if process is not None and process.poll() is None:
+            count += 1
+    return count
+
+def collect_bot_metrics():
+    bot.metrics.gauge('kbot_guilds', "Servers the bot is in.").set(len(bot.guilds))
+    bot.metrics.gauge('kbot_loaded_servers', "Servers loaded into bot.server_data.").set(len(bot.server_data))
+    bot.metrics.gauge('kbot_voice_connections', "Connected voice clients.").set(len(bot.voice_clients))
+    bot.metrics.gauge('kbot_ffmpeg_processes', "Running FFmpeg processes.").set(_ffmpeg_process_count())
+
+def find_cogs():
+    """Returns the module names of every cog in ./cogs/"""
+    return ["cogs." + file[:-3] for file in sorted(os.listdir("cogs")) if file.endswith(".py")]
+
+async def load_cog(cog):
+    start = time.perf_counter()
+    try:
+        await bot.load_extension(cog)
+        print(f"Loaded extension {cog} in {time.perf_counter() - start:.2f}s")
+    except Exception as e:
+        print(f"Failed to load extension {cog}.", file=sys.stderr)
+        traceback.print_exc()
+
+# Point discord.py at other endpoints, if configured
+if config['discord_api_url']:
+    discord.http.Route.BASE = config['discord_api_url']
+if config['discord_gateway_url']:
+    discord.gateway.DiscordWebSocket.DEFAULT_GATEWAY = yarl.URL(config['discord_gateway_url'])
+
+# In sharded mode one process runs several gateway connections (shards), each handling a share of the servers.
+# launcher.py spreads the shards over several processes of this script.
+class KBot(commands.AutoShardedBot if config['sharded'] else commands.Bot):
+    async def setup_hook(self):
+        """Runs once, after logging in but before connecting to the gateway. Reconnects don't run it again."""
+        end_phase('login')
+        # Start saving server configs. Servers themselves are loaded as they're used.
+        settings_store.start()
+        self.server_data.start_sweeping()
+        self.loop.create_task(monitor_loop_lag(config["loop_lag_interval"]))
+        if config["loop_watchdog_threshold"]:
+            self.watchdog = LoopWatchdog(self.loop, config["loop_watchdog_threshold"], metrics=self.metrics)
+            self.watchdog.start()
+
+        # Cogs don't depend on each other, so their setup() functions run concurrently
+        await asyncio.gather(*[load_cog(cog) for cog in find_cogs()])
+        end_phase('cogs')
+
+    async def close(self):
+        # Write any settings changes that are still waiting for the next batch
+        await settings_store.close()
+        if self.watchdog:
+            self.watchdog.stop()
+        await super().close()
+
+if config['sharded']:
+    bot = KBot(command_prefix=prefix_cache.get_prefix, intents=intents, shard_count=config['shard_count'], shard_ids=config['shard_ids'])
+else:
+    bot = KBot(command_prefix=prefix_cache.get_prefix, intents=intents)
+bot.server_data = ServerRegistry(idle_ttl=config["server_idle_ttl"])
 bot.config = config
+bot.startup_timings = startup_timings
+# Served by the web API at /metrics. Cogs add their own metrics & collectors
+bot.metrics = MetricsRegistry()
+bot.metrics.register_collector('bot', collect_bot_metrics)
+bot.watchdog = None  # A LoopWatchdog, if LOOP_WATCHDOG_THRESHOLD is set
+command_seconds = bot.metrics.histogram('kbot_command_seconds', "How long commands took to run, by command & outcome.", labels=('command', 'outcome'))
+
+@bot.before_invoke
+async def start_command_timer(ctx):
+    ctx.invoked_at = time.perf_counter()
+    if bot.watchdog:
+        bot.watchdog.track(ctx.command.qualified_name, ctx.guild.id if ctx.guild else None)
+
+@bot.after_invoke
+async def observe_command_time(ctx):
+    command_seconds.observe(time.perf_counter() - ctx.invoked_at, ctx.command.qualified_name, 'error' if ctx.command_failed else 'ok')
 
 async def update_status():
-    await bot.change_presence(activity=discord.CustomActivity(name=f"Jukeboxing in {len(bot.server_data)} servers."))
+    await bot.change_presence(activity=discord.CustomActivity(name=f"Jukeboxing in {len(bot.guilds)} servers."))
 
 @bot.event
 async def on_ready():
-    """Runs when the bot has initialized and authenticated with Discord."""
+    """Runs when the bot has connected to Discord's gateway. This also happens after every reconnect, so it must be safe to run again."""
     print(f"Logged in as {bot.user}")
-
-    # Load saved server configs & sets status
-    initialize_servers()
+    if bot.shard_count:
+        print(f"Running shards {', '.join(str(shard_id) for shard_id in bot.shards)} of {bot.shard_count}, for {len(bot.guilds)} servers")
+    prefix_cache.set_user(bot.user.id)
     await update_status()
 
-    # Scan for & load cog modules
-    cogs = []
-    cogsDir = os.listdir("cogs")
-    for file in cogsDir:
-        if file.endswith(".py"):
-            cogs.append("cogs." + file[:-3])    
-
-    for cog in cogs:
-        try:
-            await bot.load_extension(cog)
-        except Exception as e:
-            print(f"Failed to load extension {cog}.", file=sys.stderr)
-            traceback.print_exc()
+    if 'gateway' not in startup_timings:
+        end_phase('gateway')
+        print("Startup took " + ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in startup_timings.items())
+              + f". Total {sum(startup_timings.values()):.2f}s")
 
 @bot.event
 async def on_guild_join(guild):
-    if not guild.id in bot.server_data:
-        bot.server_data[guild.id] = Server(guild.id)
-        bot.server_data[guild.id].load_settings()
     await update_status()
 
 def main():
+    # Shut down cleanly on SIGTERM as well (eg. 'docker stop', or launcher.py), saving any pending settings
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
     bot.run(config["discord_token"], log_handler=handler)
 
 main()
\ No newline at end of file
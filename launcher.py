@@ -0,0 +1,346 @@
+"""Runs KBot as several kbot.py worker processes, each running a range of shards, so one machine can use all of its cores.
+
+The launcher is also the local coordinator for its workers:
+- It restarts workers that exit.
+- It serves the web API on API_PORT, forwarding requests to the workers' API cogs. Requests with a 'guild_id' go to
+  the worker running that guild's shard, other requests go to every worker & list results are merged.
+Settings & queues stay in the shared SQLite databases under ./servers/. Each server belongs to exactly one shard, so
+workers never write the same rows. Each worker keeps its downloaded audio in its own directory, under AUDIO_CACHE_DIR.
+
+Environment, on top of kbot.py's:
+    WORKER_PROCESSES  Number of workers. Defaults to the CPU count.
+    SHARD_COUNT       Total number of shards. Defaults to Discord's recommendation.
+    API_PORT          Port of the coordinator's API. Workers use the ports after it. Defaults to 5000.
+BROADCAST_RATE, FFMPEG_LIMIT, AUDIO_CACHE_BYTES, YTDL_WORKERS & YTDL_CONCURRENCY are for the whole machine, and split
+between the workers."""
+import asyncio
+import hashlib
+import json
+import os
+import secrets
+import signal
+import sys
+from collections import OrderedDict
+
+import aiohttp
+from dotenv import load_dotenv
+from quart import Quart, Response, make_response, request, websocket
+
+from cogs.api import KEEPALIVE_INTERVAL, MAX_PAGE_SIZE
+
+
+def _label_sample(line, label):
+    """Adds a label to a sample line of Prometheus' text format, eg. 'name{a="1"} 2' -> 'name{a="1",worker="0"} 2'"""
+    name, _, rest = line.partition(' ')
+    if name.endswith('}'):
+        return f'{name[:-1]},{label}}} {rest}'
+    return f'{name}{{{label}}} {rest}'
+
+def shard_ranges(shard_count, processes):
+    """Splits the shard IDs into 'processes' contiguous ranges."""
+    processes = max(1, min(processes, shard_count))
+    return [list(range(index * shard_count // processes, (index + 1) * shard_count // processes)) for index in range(processes)]
+
+async def recommended_shards(token, api_url):
+    async with aiohttp.ClientSession() as session:
+        async with session.get(api_url + '/gateway/bot', headers={'Authorization': f'Bot {token}'}) as response:
+            data = await response.json()
+    if 'shards' not in data:
+        raise Exception(f"Couldn't get the recommended shard count from Discord: {data.get('message', response.status)}")
+    return data['shards']
+
+
+class Worker():
+    """A kbot.py process running some of the shards."""
+    def __init__(self, index, shard_ids, shard_count, api_port, env:dict=None):
+        self.index = index
+        self.env = env or {}
+        self.shard_ids = shard_ids
+        self.shard_count = shard_count
+        self.api_port = api_port
+        self.process = None
+        self.restarts = 0
+
+    async def run(self):
+        """Runs the worker, restarting it whenever it exits, until cancelled."""
+        env = dict(os.environ,
+                   SHARD_COUNT=str(self.shard_count),
+                   SHARD_IDS=','.join(str(shard_id) for shard_id in self.shard_ids),
+                   WORKER_INDEX=str(self.index),
+                   API_HOST='127.0.0.1',
+                   API_PORT=str(self.api_port),
+                   **self.env)
+        try:
+            while True:
+                print(f"Starting worker {self.index} with shards {self.shard_ids[0]}-{self.shard_ids[-1]}")
+                self.process = await asyncio.create_subprocess_exec(sys.executable, 'kbot.py', env=env)
+                code = await self.process.wait()
+                self.restarts += 1
+                delay = min(60, 5 * self.restarts)
+                print(f"Worker {self.index} exited with code {code}, restarting in {delay}s", file=sys.stderr)
+                await asyncio.sleep(delay)
+        finally:
+            await self.stop()
+
+    async def stop(self):
+        if self.process and self.process.returncode is None:
+            # kbot.py closes the bot & saves its settings on SIGTERM
+            self.process.terminate()
+            try:
+                await asyncio.wait_for(self.process.wait(), 30)
+            except asyncio.TimeoutError:
+                self.process.kill()
+
+
+class Coordinator():
+    """Serves the web API for every worker."""
+    def __init__(self, workers, shard_count):
+        self.workers = workers
+        self.shard_count = shard_count
+        self.session = None
+        self.jobs = OrderedDict()  # Coordinator job ID -> [(worker, the worker's job ID)]
+        self.quart = Quart(__name__)
+        self.quart.add_url_rule('/api/<path:path>', 'forward', self.forward, methods=['GET', 'POST', 'PUT', 'PATCH', 'DELETE'])
+        self.quart.add_url_rule('/api/guilds/player/events', 'player_events', self.relay_events, methods=['GET'])
+        self.quart.add_websocket('/api/guilds/player/ws', 'player_socket', self.relay_socket)
+        self.quart.add_url_rule('/api/guilds/channels/messages', 'send_messages', self.send_messages, methods=['POST'])
+        self.quart.add_url_rule('/api/jobs/<job_id>', 'get_job', self.get_job, methods=['GET'])
+        self.quart.add_url_rule('/metrics', 'metrics', self.metrics, methods=['GET'])
+
+    def worker_for_guild(self, guild_id):
+        shard_id = (int(guild_id) >> 22) % self.shard_count
+        return next(worker for worker in self.workers if shard_id in worker.shard_ids)
+
+    async def forward(self, path):
+        body = await request.get_data()
+        data = await request.get_json(silent=True)
+        guild_id = (data.get('guild_id') if isinstance(data, dict) else None) or request.args.get('guild_id')
+        workers = [self.worker_for_guild(guild_id)] if guild_id else self.workers
+
+        skipped = ('host', 'content-length')
+        if len(workers) > 1:
+            # Workers' ETags are for their part of the response only
+            skipped += ('if-none-match',)
+        headers = {key: value for key, value in request.headers.items() if key.lower() not in skipped}
+        results = await asyncio.gather(*[self._request(worker, path, body, headers) for worker in workers], return_exceptions=True)
+        results = [result for result in results if not isinstance(result, Exception)]
+        if not results:
+            return {'error': 'No workers are available'}, 502
+
+        # Every worker answered, eg. GET /api/guilds. Lists are merged, otherwise the first success is used.
+        successes = [result for result in results if result[0] < 400]
+        if len(workers) > 1 and successes and all(isinstance(result[2], list) for result in successes):
+            return self._merge_lists(successes)
+        status, content_type, payload, raw, response_headers = (successes or results)[0]
+        return Response(raw, status=status, content_type=content_type,
+                        headers={key: value for key, value in response_headers.items() if key.lower() in ('etag', 'cache-control', 'x-next-cursor')})
+
+    def _merge_lists(self, results):
+        items = [item for result in results for item in result[2]]
+        headers = {}
+        cursors = [result[4]['X-Next-Cursor'] for result in results if 'X-Next-Cursor' in result[4]]
+        if 'limit' in request.args or cursors:
+            # Paginated by ID. Each worker returned its first 'limit' items after the cursor, so the first 'limit'
+            # of all of them are the first 'limit' overall
+            limit = request.args.get('limit', MAX_PAGE_SIZE, type=int)
+            items.sort(key=lambda item: int(item['id']))
+            if len(items) > limit or cursors:
+                items = items[:limit]
+                headers['X-Next-Cursor'] = str(items[-1]['id'])
+
+        body = json.dumps(items, separators=(',', ':')).encode()
+        etag = hashlib.sha1(body).hexdigest()
+        headers['ETag'] = f'"{etag}"'
+        if etag in request.if_none_match:
+            return Response(b'', status=304, headers=headers)
+        return Response(body, status=200, content_type='application/json', headers=headers)
+
+    async def send_messages(self):
+        """Submits a bulk message job to every worker. Each worker sends the messages for the channels it can see."""
+        body = await request.get_data()
+        headers = {'Content-Type': 'application/json'}
+        results = await asyncio.gather(*[self._request(worker, 'guilds/channels/messages', body, headers) for worker in self.workers],
+                                       return_exceptions=True)
+        if any(isinstance(result, Exception) for result in results):
+            return {'error': 'Not every worker is available'}, 502
+        for status, content_type, payload, raw, response_headers in results:
+            if status >= 400:
+                return Response(raw, status=status, content_type=content_type)
+
+        job_id = secrets.token_hex(8)
+        self.jobs[job_id] = [(worker, result[2]['job_id']) for worker, result in zip(self.workers, results)]
+        while len(self.jobs) > 1000:
+            self.jobs.popitem(last=False)
+        return self._merge_jobs(job_id, [result[2] for result in results]), 202
+
+    async def get_job(self, job_id):
+        if job_id not in self.jobs:
+            return {'error': 'Job not found'}, 404
+        results = await asyncio.gather(*[self._request(worker, f'jobs/{worker_job_id}', b'', {}) for worker, worker_job_id in self.jobs[job_id]],
+                                       return_exceptions=True)
+        if any(isinstance(result, Exception) or result[0] != 200 for result in results):
+            return {'error': 'Not every worker is available'}, 502
+        return self._merge_jobs(job_id, [result[2] for result in results]), 200
+
+    def _merge_jobs(self, job_id, jobs):
+        # Every worker has every item, marked 'not_found' by the workers that can't see its channel
+        items = [next((item for item in candidates if item['status'] != 'not_found'), candidates[0])
+                 for candidates in zip(*[job['items'] for job in jobs])]
+        counts = {}
+        for item in items:
+            counts[item['status']] = counts.get(item['status'], 0) + 1
+        statuses = {job['status'] for job in jobs}
+        return {
+            'job_id': job_id,
+            'status': 'done' if statuses == {'done'} else 'running' if 'running' in statuses or 'done' in statuses else 'queued',
+            'created_at': min(job['created_at'] for job in jobs),
+            'finished_at': max(job['finished_at'] for job in jobs) if statuses == {'done'} else None,
+            'total': len(items),
+            'counts': counts,
+            'items': items,
+        }
+
+    async def metrics(self):
+        """Merges the workers' /metrics, labelling every sample with its worker's index."""
+        async def scrape(worker):
+            async with self.session.get(f'http://127.0.0.1:{worker.api_port}/metrics') as response:
+                return await response.text()
+        results = await asyncio.gather(*[scrape(worker) for worker in self.workers], return_exceptions=True)
+
+        families = {}  # HELP & TYPE lines -> samples, in the order they were first seen
+        for worker, text in zip(self.workers, results):
+            if isinstance(text, Exception):
+                continue
+            header = None
+            for line in text.splitlines():
+                if line.startswith('# HELP'):
+                    header = (line,)
+                elif line.startswith('# TYPE'):
+                    header += (line,)
+                elif line and header:
+                    families.setdefault(header, []).append(_label_sample(line, f'worker="{worker.index}"'))
+        up = [f'kbot_worker_up{{worker="{worker.index}"}} {0 if isinstance(text, Exception) else 1}' for worker, text in zip(self.workers, results)]
+        families[('# HELP kbot_worker_up Whether the worker answered the scrape.', '# TYPE kbot_worker_up gauge')] = up
+        lines = [line for header, samples in families.items() for line in header + tuple(samples)]
+        return Response('\n'.join(lines) + '\n', content_type='text/plain; version=0.0.4')
+
+    def _event_workers(self, args):
+        guild_id = args.get('guild_id')
+        return [self.worker_for_guild(guild_id)] if guild_id else self.workers
+
+    async def relay_events(self):
+        """Merges the player event streams of the workers. Each worker's stream starts with its own 'state' snapshot.
+        The stream ends if any worker's stream does (eg. it restarted), and clients reconnect as usual for SSE."""
+        events = asyncio.Queue(maxsize=256)  # When full, the workers' streams wait, and their buffers absorb the backlog
+        args = request.args
+
+        async def relay(worker):
+            try:
+                url = f'http://127.0.0.1:{worker.api_port}/api/guilds/player/events'
+                async with self.session.get(url, params=args, timeout=aiohttp.ClientTimeout(total=None)) as response:
+                    buffer = b''
+                    async for chunk in response.content.iter_any():
+                        *blocks, buffer = (buffer + chunk).split(b'\n\n')
+                        for block in blocks:
+                            if not block.startswith(b':'):  # Workers' keepalives
+                                await events.put(block + b'\n\n')
+            except aiohttp.ClientError:
+                pass
+            await events.put(None)
+
+        async def stream():
+            relays = [asyncio.create_task(relay(worker)) for worker in self._event_workers(args)]
+            try:
+                while True:
+                    try:
+                        event = await asyncio.wait_for(events.get(), KEEPALIVE_INTERVAL)
+                    except asyncio.TimeoutError:
+                        yield b': keepalive\n\n'
+                        continue
+                    if event is None:
+                        return
+                    yield event
+            finally:
+                for task in relays:
+                    task.cancel()
+
+        response = await make_response(stream(), 200, {'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache'})
+        response.timeout = None
+        return response
+
+    async def relay_socket(self):
+        """Relays the workers' player event WebSockets to the client's. Closes when any of them closes."""
+        async def relay(worker):
+            url = f'ws://127.0.0.1:{worker.api_port}/api/guilds/player/ws'
+            async with self.session.ws_connect(url, params=websocket.args) as socket:
+                async for message in socket:
+                    if message.type == aiohttp.WSMsgType.TEXT:
+                        await websocket.send(message.data)
+
+        relays = [asyncio.create_task(relay(worker)) for worker in self._event_workers(websocket.args)]
+        try:
+            await asyncio.wait(relays, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in relays:
+                task.cancel()
+
+    async def _request(self, worker, path, body, headers):
+        url = f'http://127.0.0.1:{worker.api_port}/api/{path}'
+        async with self.session.request(request.method, url, params=request.args, data=body, headers=headers) as response:
+            raw = await response.read()
+            payload = None
+            if response.content_type == 'application/json':
+                payload = await response.json()
+            return response.status, response.content_type, payload, raw, response.headers
+
+    async def run(self, port, shutdown_trigger):
+        self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30))
+        try:
+            await self.quart.run_task(host='0.0.0.0', port=port, shutdown_trigger=shutdown_trigger)
+        finally:
+            await self.session.close()
+
+
+async def main():
+    load_dotenv()
+    token = os.environ.get('DISCORD_TOKEN')
+    if not token:
+        print("Environment variable(s) empty.")
+        return
+    api_url = os.environ.get('DISCORD_API_URL', 'https://discord.com/api/v10')
+    processes = int(os.environ.get('WORKER_PROCESSES', os.cpu_count() or 1))
+    shard_count = int(os.environ.get('SHARD_COUNT') or await recommended_shards(token, api_url))
+    api_port = int(os.environ.get('API_PORT', 5000))
+
+    ranges = shard_ranges(shard_count, processes)
+    # Discord's global rate limit is shared by every process using the token, so bulk messages are paced by a share of it
+    env = {'BROADCAST_RATE': str(float(os.environ.get('BROADCAST_RATE', 40)) / len(ranges))}
+    # FFMPEG_LIMIT is for the whole machine, so each worker gets a share of it
+    if int(os.environ.get('FFMPEG_LIMIT', 0)):
+        env['FFMPEG_LIMIT'] = str(max(1, int(os.environ['FFMPEG_LIMIT']) // len(ranges)))
+    # Each worker runs its own yt-dlp pool, so the machine's yt-dlp threads (or processes) are shared out too.
+    # YTDL_CONCURRENCY defaults to each worker's YTDL_WORKERS when it isn't set
+    env['YTDL_WORKERS'] = str(max(1, int(os.environ.get('YTDL_WORKERS', 4)) // len(ranges)))
+    if 'YTDL_CONCURRENCY' in os.environ:
+        env['YTDL_CONCURRENCY'] = str(max(1, int(os.environ['YTDL_CONCURRENCY']) // len(ranges)))
+    # Each worker keeps its own audio cache index & pins, so each gets its own directory and a share of AUDIO_CACHE_BYTES
+    env['AUDIO_CACHE_BYTES'] = str(int(os.environ.get('AUDIO_CACHE_BYTES', 2 * 1024**3)) // len(ranges))
+    cache_dir = os.environ.get('AUDIO_CACHE_DIR', 'downloads')
+    workers = [Worker(index, shard_ids, shard_count, api_port + index + 1, dict(env, AUDIO_CACHE_DIR=os.path.join(cache_dir, f'worker-{index}')))
+               for index, shard_ids in enumerate(ranges)]
+    print(f"Running {shard_count} shards over {len(workers)} worker processes")
+
+    stopping = asyncio.Event()
+    tasks = [asyncio.create_task(worker.run()) for worker in workers]
+    coordinator = asyncio.create_task(Coordinator(workers, shard_count).run(api_port, shutdown_trigger=stopping.wait))
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stopping.set)
+    await stopping.wait()
+    print("Stopping workers")
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(coordinator, *tasks, return_exceptions=True)
+
+if __name__ == '__main__':
+    asyncio.run(main())